@@ -0,0 +1,134 @@
+"""
+Runs the annotation stages on a sequence at the same time.
+
+A stage is a function taking the Feature_Database and the saved
+Sequence, and returning what it finds, unsaved, for one keyword argument
+of Sequence.replace_annotations. settings.ANNOTATION_STAGES lists the
+stages as (keyword, dotted path of the function) pairs; STAGES is the
+default.
+
+The first stage runs in the annotating thread. The others run on a
+process-wide pool of settings.ANNOTATION_THREADS threads, and are waited
+for before anything is stored. When annotating many sequences at once,
+all the stages of all of them run on the pool. Threads overlap as long
+as a stage runs outside Python, as the frags scanner does, and they
+share the sequence and the feature catalog without copying them.
+
+The stages on the pool run outside the annotating thread's transaction,
+each on its pool thread's own connection, which is closed once the stage
+is done, as no request ends on those threads to close it. Of STAGES, the
+features stage queries the database when the catalog is not loaded yet
+(see catalog.py); the ORF stage does not.
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+
+from giraffe.blat.catalog import get_catalog
+
+
+STAGES = (
+    ('features', 'giraffe.blat.frags.features.find_features'),
+    ('orfs', 'giraffe.blat.annotate.find_orfs'),
+)
+THREADS = 2 # Threads to run the stages after the first on
+
+
+def find_orfs(db,sequence_obj):
+    """ The ORF stage; ORFs do not depend on the feature database. """
+    from giraffe.blat import orfs
+    return orfs.find_orfs(sequence_obj)
+
+
+def _get_stage(path):
+    (module,name) = path.rsplit('.',1)
+    return getattr(import_module(module),name)
+
+def get_stages():
+    """ Returns the (keyword, function) pairs of the stages. """
+    return [(keyword,_get_stage(path)) for (keyword,path)
+            in getattr(settings,'ANNOTATION_STAGES',STAGES)]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool(threads):
+    """ Returns the process-wide pool that runs stages. """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(threads)
+        return _pool
+
+def _run_stage(stage,db,sequence_obj):
+    """ Runs a stage on a pool thread, then closes its connection. """
+    try:
+        return stage(db,sequence_obj)
+    finally:
+        connection.close()
+
+def find_annotations(db,sequence_obj,stages=None):
+    """
+    Runs the stages on the sequence, and returns a dict of what each one
+    found, by keyword.
+    """
+    if stages is None:
+        stages = get_stages()
+    threads = getattr(settings,'ANNOTATION_THREADS',THREADS)
+
+    pending = []
+    if threads > 0:
+        pool = _get_pool(threads)
+        for (keyword,stage) in stages[1:]:
+            pending.append((keyword,pool.apply_async(
+                _run_stage,(stage,db,sequence_obj))))
+        stages = stages[:1]
+
+    found = {}
+    for (keyword,stage) in stages:
+        found[keyword] = stage(db,sequence_obj)
+    for (keyword,result) in pending:
+        found[keyword] = result.get()
+    return found
+
+def find_many_annotations(db,sequence_objs,stages=None):
+    """
+    Runs the stages on each of the sequences, all of them on the pool
+    at once, and returns the dict of what they found for each sequence,
+    in order.
+    """
+    if stages is None:
+        stages = get_stages()
+    threads = getattr(settings,'ANNOTATION_THREADS',THREADS)
+    if threads == 0:
+        return [find_annotations(db,s,stages) for s in sequence_objs]
+
+    # Loaded here, so that the stages find it loaded and need not query
+    get_catalog(db)
+    pool = _get_pool(threads)
+    pending = [[(keyword,pool.apply_async(_run_stage,(stage,db,s)))
+                for (keyword,stage) in stages] for s in sequence_objs]
+    return [dict([(keyword,result.get()) for (keyword,result) in results])
+            for results in pending]
+
+def annotate(db,sequence_obj,stages=None):
+    """
+    Runs the stages on the sequence, then replaces its annotations with
+    what they found, in one transaction.
+    """
+    sequence_obj.replace_annotations(
+        **find_annotations(db,sequence_obj,stages))
+
+def annotate_many(db,sequence_objs,stages=None):
+    """
+    Runs the stages on each of the sequences, then replaces all their
+    annotations in one transaction.
+    """
+    from giraffe.blat.models import Sequence
+    Sequence.replace_many_annotations(
+        zip(sequence_objs,find_many_annotations(db,sequence_objs,stages)))
@@ -0,0 +1,95 @@
+"""
+Process-wide cache of the feature databases.
+
+Annotating a sequence needs its Feature_Database, and the Feature_DB_Index
+row and feature of every feature index the scanner reports. A catalog
+loads all of a database's index rows in one query, and keeps them with
+their FeatureData until the database's db_version changes.
+
+Feature_Database rows are kept too, and read again at most every
+settings.FEATURE_CATALOG_TTL seconds; that is how a running process
+notices a database rebuilt by fixtures/create_frag_db.py.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+from giraffe.blat.models import Feature_Database
+from giraffe.blat.models import Feature_DB_Index
+
+
+class FeatureCatalog(object):
+    """ All the Feature_DB_Index rows of one version of a database. """
+
+    def __init__(self, db):
+        from giraffe.blat.frags.frags_to_features import FeatureData
+
+        self.db = db
+        self.db_version = db.db_version
+        self.__entries = {}
+        for fdb in Feature_DB_Index.objects.filter(db=db).select_related(
+            'feature', 'feature__type'
+        ):
+            self.__entries[fdb.feature_index] = (fdb, FeatureData(fdb))
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __entry(self, feature_index):
+        try:
+            return self.__entries[feature_index]
+        except KeyError:
+            raise Feature_DB_Index.DoesNotExist(
+                'No feature index %d in database %s' %
+                (feature_index, self.db.name))
+
+    def index(self, feature_index):
+        """ Returns the Feature_DB_Index row for the feature index. """
+        return self.__entry(feature_index)[0]
+
+    def feature_data(self, feature_index):
+        """ Returns the FeatureData for the feature index. """
+        return self.__entry(feature_index)[1]
+
+
+_databases = {}
+_catalogs = {}
+_lock = threading.Lock()
+
+def get_database(db_name):
+    """
+    Returns the Feature_Database with the name; raises
+    Feature_Database.DoesNotExist if there is none.
+    """
+    ttl = getattr(settings, 'FEATURE_CATALOG_TTL', 60)
+    try:
+        (db, loaded) = _databases[db_name]
+        if time.time() - loaded < ttl:
+            return db
+    except KeyError:
+        pass
+    db = Feature_Database.objects.get(name=db_name)
+    _databases[db_name] = (db, time.time())
+    return db
+
+def get_catalog(db):
+    """ Returns the catalog for the Feature_Database's db_version. """
+    catalog = _catalogs.get(db.name)
+    if catalog is None or catalog.db_version != db.db_version:
+        with _lock:
+            catalog = _catalogs.get(db.name)
+            if catalog is None or catalog.db_version != db.db_version:
+                catalog = FeatureCatalog(db)
+                _catalogs[db.name] = catalog
+    return catalog
+
+def invalidate(db_name = None):
+    """ Forgets the named database, or all of them. """
+    with _lock:
+        for cache in (_databases, _catalogs):
+            if db_name is None:
+                cache.clear()
+            else:
+                cache.pop(db_name, None)
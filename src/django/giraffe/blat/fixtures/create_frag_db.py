@@ -6,6 +6,10 @@ KTUP = 12
 MASK = 16777215 # should be (4^KTUP)-1
 MINFRAG = 6
 
+# binary index format, must match frags.c
+INDEX_MAGIC = 'GFRAGIDX'
+INDEX_VERSION = 1
+
 SUM_VALUE_0_char = 'a'
 SUM_VALUE_1_char = 'g'
 SUM_VALUE_2_char = 'c'
@@ -103,7 +107,8 @@ def create_data_file(db):
                 fn.save()
                 features.append(fn)
                 feature_index = feature_index+1
-  
+
+
     def split_len(seq, length):
         return [seq[i:i+length] for i in range(0, len(seq), length)]
 
@@ -143,19 +148,119 @@ def create_data_file(db):
     return output
 
 
+def bump_version(db):
+    """
+    Gives the database a new version, once its new .data and .idx files
+    are in place: processes caching the old index (blat/catalog.py)
+    reload it when they see this.
+    """
+    import datetime
+    import hashlib
+    from giraffe.blat.models import Feature_Database
+
+    fdb = Feature_Database.objects.get(name=db)
+    fdb.db_version = hashlib.sha1(str(datetime.datetime.now())).hexdigest()
+    fdb.last_built = datetime.datetime.now()
+    fdb.save()
+
+
+def _write_aside(path, write, mode='w'):
+    """
+    Writes a file next to path with write(f), and returns its name, to
+    be renamed to path: readers then see either the old file or the new
+    one, whole.
+    """
+    import os
+    tmp = '%s.tmp' % path
+    f = open(tmp, mode)
+    write(f)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    return tmp
+
+
+def write_binary_index(output, f):
+    """
+    Writes the lines made by create_data_file as a binary index that the
+    frags scanner can mmap, instead of parsing the text .data file.
+
+    Layout, all little-endian unsigned 32 bit integers after the magic:
+
+        header:  magic (8 bytes), version, KTUP, number of records,
+                 number of unmasked records, number of masked records, 0
+        records: feature index, fragment index, mask, seq, shift
+
+    Unmasked records come first, sorted by seq (the k-mer table), followed
+    by the masked records, same as in the .data file.
+    """
+    import struct
+
+    records = []
+    for line in output:
+        records.append([int(v) for v in line.strip().split(',')[0:5]])
+    nkmers = 0
+    for r in records:
+        if r[2] != 0:
+            break
+        nkmers += 1
+
+    f.write(INDEX_MAGIC)
+    f.write(struct.pack('<6I', INDEX_VERSION, KTUP, len(records),
+                        nkmers, len(records) - nkmers, 0))
+    for r in records:
+        f.write(struct.pack('<5I', *r))
+
+
 if __name__ == '__main__':
+    import os
     import sys
+
+    if sys.argv[1] == '--convert':
+        # Convert an existing .data file:
+        #   python create_frag_db.py --convert <db>.data <db>.idx
+        lines = open(sys.argv[2]).read().splitlines()
+        output = lines[1:int(lines[0])+1]
+        os.rename(_write_aside(
+            sys.argv[3], lambda f: write_binary_index(output, f), 'wb'),
+            sys.argv[3])
+        sys.exit(0)
+
     sys.path.append('../../..')
 
     from django.core.management import setup_environ
     import giraffe.settings
     setup_environ(giraffe.settings)
 
-    db = sys.argv[1]
-    output = create_data_file(db)
+    # python create_frag_db.py <db> [<db>.data [<db>.idx]], the .data
+    # file to standard output if not given
+    from django.db import transaction
+
+    @transaction.commit_on_success
+    def build(db, paths):
+        output = create_data_file(db)
 
-    print len(output)
-    print '\n'.join(output)
+        if not paths:
+            # Not atomic: the shell has emptied the file already
+            print len(output)
+            print '\n'.join(output)
+            sys.stdout.flush()
+            bump_version(db)
+            return
 
+        # The binary index goes after the .data file, so that it is at
+        # least as new, and the scanner picks it (see frags/scanner.py);
+        # both are written aside, then moved into place
+        written = [_write_aside(paths[0], lambda f: f.write(
+            '%d\n%s\n' % (len(output), '\n'.join(output))))]
+        if len(paths) > 1:
+            written.append(_write_aside(
+                paths[1], lambda f: write_binary_index(output, f), 'wb'))
+        for (tmp, path) in zip(written, paths):
+            os.rename(tmp, path)
 
+        # Only now do the new feature indexes, committed with the new
+        # version, go with the files on disk
+        bump_version(db)
 
+    build(sys.argv[1], sys.argv[2:4])
\ No newline at end of file
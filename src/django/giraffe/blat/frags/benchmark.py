@@ -0,0 +1,65 @@
+"""
+Scanner benchmark: scan time against the number of masked records.
+
+Masked records (fragments shorter than a k-mer, e.g. enzyme sites and
+feature tails) are looked up by mask group, so scan time should stay flat
+as the masked table grows. This pads a copy of a feature index with random
+masked records and times scans of a random sequence with each copy.
+
+    cd giraffe/blat/frags; make; python benchmark.py [db name] [seq length]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append('../../..')
+from giraffe.blat.frags import scanner
+
+KTUP = 12
+
+
+def padded_index(db_name, extra):
+    """ Writes a copy of the .data index with extra masked records. """
+    lines = open(os.path.join(scanner.DATA_PATH, '%s.data' % db_name)).read().splitlines()
+    records = lines[1:int(lines[0])+1]
+    for i in range(extra):
+        # Long tails rarely match, so the timings measure lookups rather
+        # than reporting frags
+        length = random.randint(9, KTUP-1)
+        mask = ((1 << (2*length)) - 1) << (2*(KTUP-length))
+        seq = random.getrandbits(2*KTUP) & mask
+        records.append('%d,%d,%d,%d,%d,' % (100000+i, 0, mask, seq, 0))
+    f = tempfile.NamedTemporaryFile(suffix='.data', delete=False)
+    f.write('%d\n%s\n' % (len(records), '\n'.join(records)))
+    f.close()
+    return f.name
+
+
+def run(db_name = 'default', seq_length = 100000, repeat = 3):
+    random.seed(0)
+    sequence = ''.join(random.choice('ACGT') for i in range(seq_length))
+    print '%10s %10s %10s' % ('extra', 'scan (s)', 'frags')
+    for extra in (0, 1000, 10000, 100000):
+        path = padded_index(db_name, extra)
+        try:
+            s = scanner.Scanner(db_name, path)
+            best = None
+            for i in range(repeat):
+                t0 = time.time()
+                frags = s.scan(sequence)
+                t = time.time() - t0
+                if best is None or t < best:
+                    best = t
+            print '%10d %10.4f %10d' % (extra, best, len(frags) // 4)
+        finally:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    db_name = sys.argv[1] if len(sys.argv) > 1 else 'default'
+    seq_length = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    run(db_name, seq_length)
+
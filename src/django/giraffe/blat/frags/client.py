@@ -0,0 +1,140 @@
+"""
+Client for the frags scanning server.
+
+Start the server with something like
+
+    bin/frags -s /tmp/giraffe-frags.sock -w 4 data/default.data data/afire.data
+
+The server loads each feature database once and keeps the scanner out of
+the web process. Give a database as data/default.data:4 to scan long
+sequences against it with 4 threads. See the server mode notes in
+frags.c for the protocol.
+"""
+
+import Queue
+import array
+import socket
+import struct
+import sys
+import threading
+
+ERROR = 0xffffffff
+RECORD_SIZE = 16 # 4 unsigned 32 bit integers per frag
+
+
+class ScanError(Exception):
+    """ The server refused or failed to scan a sequence. """
+    pass
+
+
+class Connection(object):
+    """ One connection to the server; carries any number of requests. """
+
+    def __init__(self, path, timeout = None):
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__sock.settimeout(timeout)
+        self.__sock.connect(path)
+
+    def scan(self, db_name, sequence):
+        """
+        Returns the frags for the sequence, as an array('I') of (feature
+        index, fragment index, start position, shift) records.
+        """
+        if isinstance(sequence, unicode):
+            sequence = sequence.encode('ascii')
+        db_name = str(db_name)
+        self.__sock.sendall(struct.pack('!I', len(db_name)) + db_name +
+                            struct.pack('!I', len(sequence)) + sequence)
+
+        (n,) = struct.unpack('!I', self.__recv(4))
+        if n == ERROR:
+            (n,) = struct.unpack('!I', self.__recv(4))
+            raise ScanError(self.__recv(n))
+
+        frags = array.array('I')
+        frags.fromstring(self.__recv(RECORD_SIZE * n))
+        if sys.byteorder == 'little':
+            frags.byteswap()
+        return frags
+
+    def close(self):
+        self.__sock.close()
+
+    def __recv(self, n):
+        chunks = []
+        while n > 0:
+            chunk = self.__sock.recv(min(n, 1 << 16))
+            if not chunk:
+                raise socket.error('frags server closed the connection')
+            chunks.append(chunk)
+            n -= len(chunk)
+        return ''.join(chunks)
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to max_idle connections open for reuse between requests.
+
+    If a connection breaks, e.g. because the server restarted the worker
+    behind it, the request is retried once on a fresh connection.
+    """
+
+    def __init__(self, path, max_idle = 8, timeout = None):
+        self.path = path
+        self.timeout = timeout
+        self.__idle = Queue.LifoQueue(max_idle)
+
+    def scan(self, db_name, sequence):
+        try:
+            return self.__scan(self.__get(), db_name, sequence)
+        except socket.error:
+            return self.__scan(self.__connect(), db_name, sequence)
+
+    def close(self):
+        while True:
+            try:
+                self.__idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+    def __scan(self, conn, db_name, sequence):
+        try:
+            res = conn.scan(db_name, sequence)
+        except ScanError:
+            self.__put(conn)
+            raise
+        except:
+            conn.close()
+            raise
+        self.__put(conn)
+        return res
+
+    def __connect(self):
+        return Connection(self.path, self.timeout)
+
+    def __get(self):
+        try:
+            return self.__idle.get_nowait()
+        except Queue.Empty:
+            return self.__connect()
+
+    def __put(self, conn):
+        try:
+            self.__idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(path):
+    """ Returns the process-wide connection pool for the server socket. """
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
+
+def scan(path, db_name, sequence):
+    return get_pool(path).scan(db_name, sequence)
+
@@ -1,10 +1,18 @@
+import array
 import os
-import tempfile
+import subprocess
+import threading
 
 from django.conf import settings
 
 from giraffe.blat.models import Sequence
-from giraffe.blat.frags.frags_to_features import frags_to_features
+from giraffe.blat.frags.frags_to_features import frag_groups_to_features
+from giraffe.blat.frags.frags_to_features import pruning_counts
+from giraffe.blat.frags.frags_to_features import _group_frags_by_feature_index
+from giraffe.blat.frags.frags_to_features import _group_frag_stream
+from giraffe.blat.frags import client
+from giraffe.blat.frags import numpy_scanner
+from giraffe.blat.frags import scanner
 
 # For Debugging
 import time
@@ -17,58 +25,164 @@ def timer():
         t0 = t
 
 
+# Marks the end of a sequence's records in "bin/frags -b" output
+FRAGS_END = 0xffffffff
+RECORD_SIZE = 16 # 4 unsigned 32 bit integers per frag
+READ_SIZE = 1 << 16
+
+def _feed(f, sequence):
+    try:
+        f.write(sequence)
+    except IOError:
+        # The scanner exited early; the reader reports it
+        pass
+    finally:
+        f.close()
+
+def _iter_frags_from_binary(db_name,sequence,grouped=False):
+    """
+    Runs the bin/frags program on the sequence, fed through its stdin,
+    and yields the packed records it writes, as array('I') chunks, as
+    soon as they arrive. With grouped, the program writes the frags
+    grouped by feature index (frags -g).
+    """
+
+    BIN_PATH = os.path.dirname(__file__)
+
+    cmd = [os.path.join(BIN_PATH, 'bin', 'frags'), '-b']
+    if grouped:
+        cmd.append('-g')
+    cmd.extend([scanner.index_path(db_name), '-'])
+
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    feeder = threading.Thread(target=_feed, args=(p.stdin, sequence))
+    feeder.daemon = True
+    feeder.start()
+
+    ended = False
+    try:
+        pending = ''
+        while True:
+            data = os.read(p.stdout.fileno(), READ_SIZE)
+            if not data:
+                break
+            if ended:
+                raise Exception('Error: bin/frags wrote past the end')
+            data = pending + data
+            n = len(data) - len(data) % RECORD_SIZE
+            pending = data[n:]
+            chunk = array.array('I')
+            chunk.fromstring(data[:n])
+            if chunk[-4:].tolist() == [FRAGS_END] * 4:
+                ended = True
+                chunk = chunk[:-4]
+            if chunk:
+                yield chunk
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.stdout.close()
+        p.wait()
+        feeder.join()
+
+    if not ended:
+        raise Exception('Error: bin/frags output ends early')
+
+def _get_frags_from_binary(db_name,sequence):
+    """
+    Runs the bin/frags program on the sequence, and loads the packed
+    records it writes.
+    """
+    frags = array.array('I')
+    for chunk in _iter_frags_from_binary(db_name,sequence):
+        frags.extend(chunk)
+    return frags
+
+def _engine():
+    """
+    Returns the scan engine settings.FRAGS_ENGINE asks for, or 'binary'
+    if it is not available here.
+    """
+    engine = getattr(settings, 'FRAGS_ENGINE', 'library')
+    if engine == 'server':
+        return engine
+    if engine == 'library' and scanner.available():
+        return engine
+    if engine == 'numpy' and numpy_scanner.available():
+        return engine
+    return 'binary'
+
 def _get_frags(db_name,sequence):
     """
-    Returns list of feature fragments for the sequence, after
-    detecting features using the specified feature database. Each
-    member of the list is a string with 4 numbers:
+    Returns the feature fragments for the sequence, after detecting
+    features using the specified feature database, as an array('I') of
+    packed records. Each record is 4 numbers:
 
     feature index
     fragment index
     start position
     shift
-    """
-
-    DATA_PATH = BIN_PATH = os.path.dirname(__file__)
-
-    tmp_file = tempfile.NamedTemporaryFile(delete=False)
-    tmp_file.write(sequence)
-    tmp_file.close()
-
-    cmd = '%s/bin/frags %s/data/%s.data %s' % (
-        BIN_PATH, DATA_PATH, db_name, tmp_file.name
-    )
 
-    f = os.popen(cmd)
-    res = f.readlines()
-    os.unlink(tmp_file.name)
+    Uses the in-process scanner library if it has been built, the frags
+    server, or the NumPy scanner, as settings.FRAGS_ENGINE says; falls
+    back to running the bin/frags program.
+    """
 
-    for i,line in enumerate(res):
-        if i == 0:
-            if not line.startswith("===="):
-                raise Exception('Error: '+line)
-        res[i] = line.strip()
-    res.pop(0)
-    # print str(res)
+    engine = _engine()
+    if engine == 'server':
+        return client.scan(settings.FRAGS_SERVER_SOCKET,db_name,sequence)
+    if engine == 'library':
+        threads = getattr(settings, 'FRAGS_SCAN_THREADS', {}).get(db_name, 1)
+        return scanner.scan(db_name,sequence,threads)
+    if engine == 'numpy':
+        return numpy_scanner.scan(db_name,sequence)
+    return _get_frags_from_binary(db_name,sequence)
+
+def _get_frag_groups(db_name,sequence):
+    """
+    Returns the feature fragments for the sequence as (feature index,
+    list of Frags) groups, in order of each group's first frag.
 
-    return res
+    When running the bin/frags program, the groups are generated as the
+    program writes them, so building trains for one group overlaps with
+    the program writing the next, and only one group's Frags are made at
+    a time.
+    """
+    if _engine() == 'binary':
+        return _group_frag_stream(
+            _iter_frags_from_binary(db_name,sequence,grouped=True))
+    return _group_frags_by_feature_index(_get_frags(db_name,sequence))
 
-def blat(db,sequence_obj):
+def find_features(db,sequence_obj):
+    """
+    Returns the features found in the sequence, as unsaved
+    Sequence_Features.
+    """
     if _debug: 
         t = timer()
         t.next()
-    frags = _get_frags(db.name,Sequence.convert_to_dna(sequence_obj.sequence))
-    if _debug: print "get_frags took %f seconds" % t.next()
+    groups = _get_frag_groups(db.name,
+                              Sequence.convert_to_dna(sequence_obj.sequence))
 
-    # Translate frags to features and store them into the database
+    # Translate frags to features
     seq_length = len(sequence_obj.sequence)
-    features = frags_to_features(frags, db, seq_length)
-    if _debug: print "frags_to_features took %f seconds" % t.next()
+    features = frag_groups_to_features(groups, db, seq_length)
+    if _debug: print "get_frags and frags_to_features took %f seconds" % t.next()
+    if _debug: print "Trains pruned so far: %s" % pruning_counts()
 
-    # Store features into database
-    if _debug: print "Storing %d features" % len(features)
     for feature in features:
         feature.sequence = sequence_obj
-        feature.save()
+    return features
+
+def blat(db,sequence_obj):
+    """ Replaces the sequence's features with the ones found in it. """
+    features = find_features(db,sequence_obj)
+
+    # Store features into database
+    if _debug: 
+        t = timer()
+        t.next()
+        print "Storing %d features" % len(features)
+    sequence_obj.replace_annotations(features=features)
     if _debug: print "Database adds took %f seconds" % t.next()
 
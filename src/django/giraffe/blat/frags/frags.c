@@ -4,7 +4,18 @@
 #include <string.h>
 #include <stdlib.h>
 #include <stdio.h>
+#include <ctype.h>
 #include <assert.h>
+#include <errno.h>
+#include <pthread.h>
+#include <signal.h>
+#include <unistd.h>
+#include <arpa/inet.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
+#include <sys/wait.h>
 
 struct feature {
   unsigned feature_index;
@@ -13,15 +24,6 @@ struct feature {
   unsigned shift;
 };
 
-extern int NFEATURES;
-extern void load_features (char *);
-extern void* get_iterator_data ();
-extern void free_iterator_data (void *v);
-extern int
-iterate (const char *s,
-         unsigned size, unsigned idx,
-         void *v, struct feature *f);
-
 struct feature_desc {
   unsigned feature_index;
   unsigned fragment_index;
@@ -30,35 +32,127 @@ struct feature_desc {
   unsigned shift;
 };
 
-struct site_ext { unsigned short on; };
+// A loaded feature database. Everything the scanner needs lives here,
+// so several databases can be loaded in one process and scanned from
+// several threads at once.
+//
+// Unmasked records F[0..nkmers) are sorted by seq. They are looked up
+// through a bucket directory indexed by the top bits of the k-mer:
+// records for bucket b are F[buckets[b]..buckets[b+1]). The directory
+// is sized to the database, about one record per bucket, instead of one
+// slot per possible k-mer.
+//
+// Masked records (short tails, which only need their first few bases to
+// match) are grouped by mask. Within a group they are sorted by seq and
+// looked up the same way, by the k-mer ANDed with the group's mask, so
+// each position costs one lookup per distinct mask rather than a test
+// against every masked record.
+struct mask_group {
+  unsigned mask;
+  unsigned n;
+  unsigned *idx;        // record indices, sorted by seq, then index
+  unsigned bucket_shift;
+  unsigned *buckets;
+};
+
+struct frags_db {
+  int nfeatures;
+  struct feature_desc *F;
+  unsigned nkmers;
+  unsigned bucket_shift;
+  unsigned *buckets;
+  unsigned ngroups;
+  struct mask_group *groups;
+  unsigned overhang;    // bases to scan past the circular junction
+  void *map;            // binary index, if F points into one
+  size_t map_size;
+};
+
+#define MIN_BUCKET_BITS 8
+#define MIN_GROUP_BUCKET_BITS 4
+
+#define INDEX_MAGIC "GFRAGIDX"
+#define INDEX_VERSION 1
+
+struct index_header {
+  char magic[8];
+  unsigned version;
+  unsigned ktup;
+  unsigned nfeatures;
+  unsigned nkmers;
+  unsigned nmasked;
+  unsigned reserved;
+};
+
+// State of a scan in progress. The sequence is fed to the scanner in
+// chunks, so memory does not grow with its length. Plasmids are
+// circular: to find features that cross the 0 bp boundary, the first
+// bases, up to the longest feature plus a k-mer, are kept and scanned
+// again after the last one (see scan_finish).
+struct scan_state {
+  unsigned sval;
+  unsigned nbases;      // bases scanned so far
+  unsigned warmup;      // report k-mers once nbases reaches this
+  char *head;           // the first bases of the sequence
+  unsigned nhead;
+  unsigned *matched;    // masked records hit at the current position
+};
+
+#define CHUNK_SIZE 65536
+
+// A parallel scan splits the k-mer start positions into ranges, one per
+// thread. Each thread reads KTUP-1 bases past the end of its range, so
+// together they see every k-mer exactly once; concatenating their hits
+// in range order gives the serial scan's output. Ranges are at least
+// this many bases, smaller sequences are not worth the threads.
+#define MIN_THREAD_BASES 65536
+#define MAX_THREADS 64
+
+// Growable list of hits returned by a scan.
+struct frags_hits {
+  struct feature *f;
+  unsigned n;
+  unsigned size;
+};
+
+struct scan_job {
+  struct frags_db *db;
+  const char *s;
+  unsigned from, to;    // scan bases s[from..to)
+  struct frags_hits hits;
+  int status;
+};
 
-struct feature_desc *F;
-int M_zero = -1;
-unsigned F_index[MASK+1];
+extern struct frags_db *frags_load (const char *);
+extern void frags_free (struct frags_db *);
+extern int frags_scan (struct frags_db *, const char *, unsigned,
+                       struct feature **);
+extern int frags_scan_threads (struct frags_db *, const char *, unsigned,
+                               int, struct feature **);
+extern void frags_free_hits (struct feature *);
 
-int NFEATURES = 0;
 #define MAX_NFEATURES 1024*1024
 
-void
-load_features (char *blastdata)
+// Parses the text index: a line with the number of records, then one
+// "feature index,fragment index,mask,seq,shift," line per record.
+static int
+load_text_index (struct frags_db *db, FILE *fp)
 {
   char buf[1024];
-  FILE *fp;
   unsigned n;
+  struct feature_desc *F;
 
-  fp = fopen (blastdata, "r");
-  if (fgets (buf, 1024, fp) == NULL) {
-    assert ("bad index");
-    return;
-  }
-  NFEATURES = atoi (buf);
-  assert (NFEATURES < MAX_NFEATURES);
-  F = (struct feature_desc*)
-    malloc (sizeof (struct feature_desc)*(NFEATURES));
-  bzero(F_index,sizeof(F_index));
+  if (fgets (buf, 1024, fp) == NULL)
+    return -1;
+  db->nfeatures = atoi (buf);
+  assert (db->nfeatures < MAX_NFEATURES);
+  F = db->F = (struct feature_desc*)
+    malloc (sizeof (struct feature_desc)*(db->nfeatures));
+  if (F == NULL)
+    return -1;
 
   n = 0;
-  while (fgets (buf, 1024, fp) && n < NFEATURES) {
+  while (fgets (buf, 1024, fp) && n < db->nfeatures) {
     char word[1024];
     unsigned i, j, nw;
     nw = 0;
@@ -83,201 +177,997 @@ load_features (char *blastdata)
 	    j=0;
       }
     }
-	if (F[n].mask != 0 && M_zero < 0)
-	  M_zero = n;
-	else if (F_index[F[n].seq] == 0)
-	  F_index[F[n].seq]=n+1;
 	n++;
   }
+  return 0;
+}
 
+// Maps the binary index written by create_frag_db.py read-only, so every
+// process scanning with it shares the same page-cached copy. Layout:
+//
+//   header:  "GFRAGIDX", version, KTUP, number of records, number of
+//            unmasked records, number of masked records, 0
+//   records: struct feature_desc, unmasked ones sorted by seq, then
+//            the masked ones
+//
+// All integers are little-endian unsigned 32 bit.
+static int
+load_binary_index (struct frags_db *db, int fd)
+{
+  struct stat st;
+  struct index_header *h;
+
+  if (fstat (fd, &st) < 0 || st.st_size < sizeof (struct index_header))
+    return -1;
+  db->map = mmap (NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+  if (db->map == MAP_FAILED) {
+    db->map = NULL;
+    return -1;
+  }
+  db->map_size = st.st_size;
+
+  h = (struct index_header *) db->map;
+  if (h->version != INDEX_VERSION || h->ktup != KTUP ||
+      h->nkmers + h->nmasked != h->nfeatures ||
+      h->nfeatures >= MAX_NFEATURES ||
+      st.st_size < sizeof (struct index_header) +
+                   sizeof (struct feature_desc)*h->nfeatures)
+    return -1;
+  db->nfeatures = h->nfeatures;
+  db->F = (struct feature_desc *) (h+1);
+  return 0;
+}
+
+// Fills buckets[0..2^bits] so that sorted keys with top bits b, i.e.
+// key >> (2*KTUP-bits) == b, are at positions buckets[b]..buckets[b+1].
+static unsigned *
+make_buckets (struct feature_desc *F, unsigned *idx, unsigned n,
+              unsigned bits)
+{
+  unsigned b, i, nbuckets = 1u << bits;
+  unsigned shift = 2*KTUP - bits;
+  unsigned *buckets = (unsigned*) malloc (sizeof (unsigned)*(nbuckets+1));
+  if (buckets == NULL)
+    return NULL;
+  for (b=0, i=0; b<=nbuckets; b++) {
+    while (i < n && (F[idx ? idx[i] : i].seq >> shift) < b)
+      i++;
+    buckets[b] = i;
+  }
+  return buckets;
+}
+
+struct seq_idx { unsigned seq, idx; };
+
+static int
+cmp_seq_idx (const void *a, const void *b)
+{
+  const struct seq_idx *x = (const struct seq_idx *) a;
+  const struct seq_idx *y = (const struct seq_idx *) b;
+  if (x->seq != y->seq)
+    return x->seq < y->seq ? -1 : 1;
+  return x->idx < y->idx ? -1 : (x->idx > y->idx);
+}
+
+// Groups the masked records by mask, see struct mask_group.
+static int
+index_masked_features (struct frags_db *db)
+{
+  struct feature_desc *F = db->F;
+  struct seq_idx *tmp;
+  unsigned n, g, j, bits, maxbits;
+
+  db->groups = (struct mask_group*)
+    calloc (db->nfeatures-db->nkmers+1, sizeof (struct mask_group));
+  tmp = (struct seq_idx*)
+    malloc (sizeof (struct seq_idx)*(db->nfeatures-db->nkmers+1));
+  if (db->groups == NULL || tmp == NULL) {
+    free (tmp);
+    return -1;
+  }
+
+  for (n=db->nkmers; n<db->nfeatures; n++) {
+    for (g=0; g<db->ngroups && db->groups[g].mask != F[n].mask; g++) ;
+    if (g == db->ngroups) {
+      db->groups[g].mask = F[n].mask;
+      db->ngroups++;
+    }
+    db->groups[g].n++;
+  }
+
+  for (g=0; g<db->ngroups; g++) {
+    struct mask_group *grp = &db->groups[g];
+    for (n=db->nkmers, j=0; n<db->nfeatures; n++)
+      if (F[n].mask == grp->mask) {
+        tmp[j].seq = F[n].seq;
+        tmp[j].idx = n;
+        j++;
+      }
+    qsort (tmp, grp->n, sizeof (struct seq_idx), cmp_seq_idx);
+    grp->idx = (unsigned*) malloc (sizeof (unsigned)*grp->n);
+    if (grp->idx == NULL) {
+      free (tmp);
+      return -1;
+    }
+    for (j=0; j<grp->n; j++)
+      grp->idx[j] = tmp[j].idx;
+
+    // Only the leading bits of the mask are significant in a key
+    for (maxbits=0; maxbits<2*KTUP &&
+                    (grp->mask & (1u << (2*KTUP-1-maxbits))); maxbits++) ;
+    for (bits=MIN_GROUP_BUCKET_BITS; (1u << bits) < grp->n && bits < 2*KTUP; bits++) ;
+    if (bits > maxbits)
+      bits = maxbits;
+    grp->bucket_shift = 2*KTUP - bits;
+    grp->buckets = make_buckets (F, grp->idx, grp->n, bits);
+    if (grp->buckets == NULL) {
+      free (tmp);
+      return -1;
+    }
+  }
+  free (tmp);
+  return 0;
+}
+
+// Builds the k-mer bucket directory over the sorted unmasked records.
+static int
+index_features (struct frags_db *db)
+{
+  unsigned n, bits;
+  struct feature_desc *F = db->F;
+
+  for (n=0; n<db->nfeatures && F[n].mask == 0; n++) ;
+  db->nkmers = n;
+
+  db->overhang = KTUP;
+  for (n=0; n<db->nfeatures; n++)
+    if ((F[n].fragment_index+2)*KTUP > db->overhang)
+      db->overhang = (F[n].fragment_index+2)*KTUP;
+
+  for (bits=MIN_BUCKET_BITS; (1u << bits) < db->nkmers && bits < 2*KTUP; bits++) ;
+  db->bucket_shift = 2*KTUP - bits;
+  db->buckets = make_buckets (F, NULL, db->nkmers, bits);
+  if (db->buckets == NULL)
+    return -1;
+  return index_masked_features (db);
+}
+
+struct frags_db *
+frags_load (const char *blastdata)
+{
+  char magic[sizeof (INDEX_MAGIC)-1];
+  FILE *fp;
+  struct frags_db *db;
+  int r;
+
+  fp = fopen (blastdata, "r");
+  if (fp == NULL)
+    return NULL;
+  db = (struct frags_db*) calloc (1, sizeof (struct frags_db));
+  if (db == NULL) {
+    fclose (fp);
+    return NULL;
+  }
+
+  if (fread (magic, 1, sizeof (magic), fp) == sizeof (magic) &&
+      memcmp (magic, INDEX_MAGIC, sizeof (magic)) == 0)
+    r = load_binary_index (db, fileno (fp));
+  else {
+    rewind (fp);
+    r = load_text_index (db, fp);
+  }
   fclose (fp);
+
+  if (r < 0 || index_features (db) < 0) {
+    frags_free (db);
+    return NULL;
+  }
+  return db;
 }
 
-void* get_iterator_data ()
+void
+frags_free (struct frags_db *db)
 {
-  unsigned n;
-  void *x;
-  unsigned *y;
-  unsigned i;
-  struct site_ext *v;
-  n = sizeof (struct site_ext) * (NFEATURES);
-  n += sizeof (unsigned);
-  x = (void *)malloc (n);
-  y = (unsigned*)x;
-  *y = 0;
-  v = (struct site_ext *)(x+sizeof(unsigned));
-  for (i=0; i<NFEATURES; i++) { v [i].on = 0; }
-  return x;
-}
-
-void free_iterator_data (void *v) { free (v); }
-  
-static int on_list[MAX_NFEATURES];
-unsigned int on_list_cur = 0;
+  if (db == NULL)
+    return;
+  if (db->map)
+    munmap (db->map, db->map_size);
+  else
+    free (db->F);
+  free (db->buckets);
+  if (db->groups) {
+    unsigned g;
+    for (g=0; g<db->ngroups; g++) {
+      free (db->groups[g].idx);
+      free (db->groups[g].buckets);
+    }
+    free (db->groups);
+  }
+  free (db);
+}
 
-int
-iterate (const char *s, unsigned size, unsigned idx,
-         void *v, struct feature *f)
-{
-  unsigned i,oi;
-  unsigned *p = (unsigned *)v;
-  register unsigned sval = (unsigned) (*p);
-  register unsigned bidx = 0;
-  struct site_ext *x = (struct site_ext *) (v+sizeof(unsigned));
-  if (idx >= KTUP-1) bidx = idx-(KTUP-1);
-  while (idx < size) {
-    for (oi=0; oi<on_list_cur; oi++) {
-      if (on_list[oi] == -1) continue;
-      i = on_list[oi];
-	  on_list[oi] = -1;
-      if (x [i].on) {
-        f->feature_index = F[i].feature_index;
-        f->fragment_index = F[i].fragment_index;
-        f->position = bidx-1;
-        f->shift = F[i].shift;
-        x [i].on = 0;
-        *p = sval;
-        return idx;
+static int
+add_hit (struct frags_hits *hits, struct feature_desc *d, unsigned position)
+{
+  struct feature *f;
+  if (hits->n == hits->size) {
+    unsigned size = hits->size ? hits->size*2 : 1024;
+    struct feature *p = (struct feature *)
+      realloc (hits->f, sizeof (struct feature)*size);
+    if (p == NULL)
+      return -1;
+    hits->f = p;
+    hits->size = size;
+  }
+  f = &hits->f[hits->n++];
+  f->feature_index = d->feature_index;
+  f->fragment_index = d->fragment_index;
+  f->position = position;
+  f->shift = d->shift;
+  return 0;
+}
+
+// Reports every record matching the k-mer starting at position (1-based):
+// unmasked records first, then masked ones, each in record order.
+static int
+lookup_kmer (struct frags_db *db, struct scan_state *st, unsigned sval,
+             unsigned position, struct frags_hits *hits)
+{
+  struct feature_desc *F = db->F;
+  unsigned b = sval >> db->bucket_shift;
+  unsigned end = db->buckets[b+1];
+  unsigned i, g, nm = 0;
+
+  for (i=db->buckets[b]; i<end && F[i].seq < sval; i++) ;
+  for (; i<end && F[i].seq == sval; i++)
+    if (add_hit (hits, &F[i], position) < 0)
+      return -1;
+
+  for (g=0; g<db->ngroups; g++) {
+    struct mask_group *grp = &db->groups[g];
+    unsigned key = sval & grp->mask;
+    unsigned j;
+    b = key >> grp->bucket_shift;
+    end = grp->buckets[b+1];
+    for (j=grp->buckets[b]; j<end && F[grp->idx[j]].seq < key; j++) ;
+    for (; j<end && F[grp->idx[j]].seq == key; j++) {
+      unsigned k = nm++;
+      // Insertion sort, to report masked hits in record order
+      while (k > 0 && st->matched[k-1] > grp->idx[j]) {
+        st->matched[k] = st->matched[k-1];
+        k--;
       }
+      st->matched[k] = grp->idx[j];
     }
-    on_list_cur = 0;
+  }
+  for (i=0; i<nm; i++)
+    if (add_hit (hits, &F[st->matched[i]], position) < 0)
+      return -1;
+  return 0;
+}
 
-    if (s [idx] == 'A' || s [idx] == 'a')
-      sval = (sval << 2) + 0;
-    else if (s [idx] == 'G' || s [idx] == 'g')
+// Scans normalized bases, continuing from where the last call left off.
+static int
+scan_bases (struct frags_db *db, struct scan_state *st, const char *s,
+            unsigned n, struct frags_hits *hits)
+{
+  register unsigned sval = st->sval;
+  unsigned i;
+
+  for (i=0; i<n; i++) {
+    if (s [i] == 'G')
       sval = (sval << 2) + 1;
-    else if (s [idx] == 'C' || s [idx] == 'c')
+    else if (s [i] == 'C')
       sval = (sval << 2) + 2;
-    else if (s [idx] == 'T' || s [idx] == 't')
+    else if (s [i] == 'T')
       sval = (sval << 2) + 3;
-    if (idx < KTUP-1) {
-      idx++;
+    else
+      sval = (sval << 2) + 0;
+    st->nbases++;
+    if (st->nbases < st->warmup)
       continue;
-    }
     sval = sval & MASK;
+    if (lookup_kmer (db, st, sval, st->nbases-KTUP+1, hits) < 0)
+      return -1;
+  }
+  st->sval = sval;
+  return 0;
+}
 
-#if 1
-    if (F_index[sval]>0) {
-      for (i=F_index[sval]-1;
-	       i<NFEATURES && F[i].seq == sval && F[i].mask == 0; i++) {
-        if (x [i].on == 0) {
-          x [i].on = 1;
-		  on_list[on_list_cur] = i;
-		  on_list_cur++;
-        }
-      }
-	}
-	if (M_zero >= 0) {
-	  for (i=M_zero; i<NFEATURES; i++) {
-        if (x [i].on == 0) {
-          if ((sval & F[i].mask) == F[i].seq) {
-            x [i].on = 1;
-		    on_list[on_list_cur] = i;
-		    on_list_cur++;
-          }
-        }
-	  }
-	}
-#else
-    for (i=0; i<NFEATURES; i++) {
-      if (x [i].on == 0) {
-        if ((F[i].mask == 0 && sval == F[i].seq) ||
-	        (F[i].mask && (sval & F[i].mask) == F[i].seq)) {
-          x [i].on = 1;
-		  on_list[on_list_cur] = i;
-		  on_list_cur++;
-        }
-      }
+// Normalizes one sequence character for the scanner. Returns 0 for
+// characters that should be skipped.
+static int
+normalize_base (int c)
+{
+  // XXX: we don't handle wildcards yet
+  if (c == ' ' || c == '\n')
+    return 0;
+  c = toupper (c);
+  if (c != 'A' && c != 'G' && c != 'C' && c != 'T')
+    return 'A';
+  return c;
+}
+
+static int
+scan_start (struct frags_db *db, struct scan_state *st)
+{
+  memset (st, 0, sizeof (*st));
+  st->warmup = KTUP;
+  st->head = (char *) malloc (db->overhang);
+  st->matched = (unsigned *)
+    malloc (sizeof (unsigned)*(db->nfeatures-db->nkmers+1));
+  if (st->head == NULL || st->matched == NULL)
+    return -1;
+  return 0;
+}
+
+static void
+scan_free (struct scan_state *st)
+{
+  free (st->head);
+  free (st->matched);
+}
+
+// Feeds a chunk of the sequence, as given, to the scan.
+static int
+scan_feed (struct frags_db *db, struct scan_state *st, const char *seq,
+           unsigned len, struct frags_hits *hits)
+{
+  char buf[CHUNK_SIZE];
+  unsigned i, n;
+
+  while (len > 0) {
+    for (i=0, n=0; i<len && n<CHUNK_SIZE; i++) {
+      int c = normalize_base (seq[i]);
+      if (c)
+        buf[n++] = c;
     }
-#endif
-    idx++;
-    bidx++;
-  }
-  for (oi=0; oi<on_list_cur; oi++) {
-    if (on_list[oi] == -1) continue;
-    i = on_list[oi];
-	on_list[oi] = -1;
-    if (x [i].on) {
-      f->feature_index = F[i].feature_index;
-      f->fragment_index = F[i].fragment_index;
-      f->position = bidx-1;
-      f->shift = F[i].shift;
-      x [i].on = 0;
-      *p = sval;
-      return idx;
+    seq += i;
+    len -= i;
+    if (st->nhead < db->overhang) {
+      unsigned m = db->overhang - st->nhead;
+      if (m > n)
+        m = n;
+      memcpy (st->head+st->nhead, buf, m);
+      st->nhead += m;
     }
+    if (scan_bases (db, st, buf, n, hits) < 0)
+      return -1;
   }
-  on_list_cur = 0;
+  return 0;
+}
 
-  return -1;
+// Scans across the circular junction, by scanning the first bases again.
+// For sequences shorter than the overhang this is the whole sequence, as
+// if it had been doubled.
+static int
+scan_finish (struct frags_db *db, struct scan_state *st,
+             struct frags_hits *hits)
+{
+  return scan_bases (db, st, st->head, st->nhead, hits);
+}
+
+int
+frags_scan (struct frags_db *db, const char *seq, unsigned len,
+            struct feature **out)
+{
+  struct scan_state st;
+  struct frags_hits hits = { NULL, 0, 0 };
+
+  if (scan_start (db, &st) < 0 ||
+      scan_feed (db, &st, seq, len, &hits) < 0 ||
+      scan_finish (db, &st, &hits) < 0) {
+    scan_free (&st);
+    free (hits.f);
+    return -1;
+  }
+  scan_free (&st);
+  *out = hits.f;
+  return hits.n;
+}
+
+static void *
+scan_job_run (void *arg)
+{
+  struct scan_job *job = (struct scan_job *) arg;
+  struct scan_state st;
+
+  job->status = -1;
+  if (scan_start (job->db, &st) == 0) {
+    // Start mid-sequence: positions count from the start of the
+    // sequence, and the first KTUP-1 bases only fill the k-mer
+    st.nbases = job->from;
+    st.warmup = job->from+KTUP;
+    job->status = scan_bases (job->db, &st, job->s+job->from,
+                              job->to-job->from, &job->hits);
+  }
+  scan_free (&st);
+  return NULL;
 }
 
-#define MAXSEQLEN 600000
+// Same as frags_scan, but splits the scan over up to nthreads threads.
+int
+frags_scan_threads (struct frags_db *db, const char *seq, unsigned len,
+                    int nthreads, struct feature **out)
+{
+  struct scan_job jobs[MAX_THREADS];
+  pthread_t threads[MAX_THREADS];
+  int started[MAX_THREADS];
+  struct feature *f;
+  char *s;
+  unsigned i, n, npos, per, total;
+  int t, r = 0;
+
+  if (nthreads <= 1)
+    return frags_scan (db, seq, len, out);
+  if (nthreads > MAX_THREADS)
+    nthreads = MAX_THREADS;
+
+  // The sequence, followed by the overhang scan_finish would scan
+  s = (char *) malloc (len+db->overhang);
+  if (s == NULL)
+    return -1;
+  for (i=0, n=0; i<len; i++) {
+    int c = normalize_base (seq[i]);
+    if (c)
+      s[n++] = c;
+  }
+  total = n + (n < db->overhang ? n : db->overhang);
+  memcpy (s+n, s, total-n);
+
+  npos = total >= KTUP ? total-KTUP+1 : 0;
+  per = (npos+nthreads-1)/nthreads;
+  if (per < MIN_THREAD_BASES)
+    per = MIN_THREAD_BASES;
+  nthreads = npos ? (npos+per-1)/per : 1;
+
+  for (t=0; t<nthreads; t++) {
+    unsigned to = (t+1)*per < npos ? (t+1)*per : npos;
+    jobs[t].db = db;
+    jobs[t].s = s;
+    jobs[t].from = t*per;
+    jobs[t].to = npos ? to+KTUP-1 : 0;
+    jobs[t].hits.f = NULL;
+    jobs[t].hits.n = jobs[t].hits.size = 0;
+  }
+  for (t=1; t<nthreads; t++) {
+    started[t] = pthread_create (&threads[t], NULL, scan_job_run, &jobs[t]) == 0;
+    if (!started[t])
+      scan_job_run (&jobs[t]);
+  }
+  scan_job_run (&jobs[0]);
+  for (t=1; t<nthreads; t++)
+    if (started[t])
+      pthread_join (threads[t], NULL);
+  free (s);
+
+  for (t=0, n=0; t<nthreads; t++) {
+    if (jobs[t].status < 0)
+      r = -1;
+    n += jobs[t].hits.n;
+  }
+  f = (struct feature *) malloc (sizeof (struct feature)*(n ? n : 1));
+  if (f == NULL)
+    r = -1;
+  for (t=0, n=0; t<nthreads; t++) {
+    if (r == 0)
+      memcpy (f+n, jobs[t].hits.f, sizeof (struct feature)*jobs[t].hits.n);
+    n += jobs[t].hits.n;
+    free (jobs[t].hits.f);
+  }
+  if (r < 0) {
+    free (f);
+    return -1;
+  }
+  *out = f;
+  return n;
+}
+
+void frags_free_hits (struct feature *f) { free (f); }
+
+#ifndef FRAGS_LIBRARY
+
+// With -b, hits are written as packed records instead of text lines:
+// struct feature, four unsigned 32 bit integers in the machine's byte
+// order, so they load directly into an array('I') or a NumPy array.
+// Each file's records end with a record of all FRAGS_END.
+#define FRAGS_END 0xffffffff
+
+static int binary_output = 0;
+
+// With -g, each file's hits are written grouped by feature index, the
+// groups in order of their first hit and the hits within a group in scan
+// order, so a reader can process a group as soon as the next one starts.
+static int grouped_output = 0;
+
+static void
+print_hits (struct frags_hits *hits)
+{
+  unsigned i;
+  if (binary_output)
+    fwrite (hits->f, sizeof (struct feature), hits->n, stdout);
+  else
+    for (i=0; i<hits->n; i++)
+      printf ("%d %d %d %d\n",
+	      hits->f[i].feature_index, hits->f[i].fragment_index,
+	      hits->f[i].position, hits->f[i].shift);
+  hits->n = 0;
+}
+
+// Stably reorders the hits by feature index, see grouped_output.
+static int
+group_hits (struct frags_hits *hits)
+{
+  unsigned *rank, *start;
+  unsigned i, max = 0, nranks = 0;
+  struct feature *f;
+
+  if (hits->n == 0)
+    return 0;
+  for (i=0; i<hits->n; i++)
+    if (hits->f[i].feature_index > max)
+      max = hits->f[i].feature_index;
+  rank = (unsigned *) calloc (max+1, sizeof (unsigned));
+  start = (unsigned *) calloc (hits->n+1, sizeof (unsigned));
+  f = (struct feature *) malloc (sizeof (struct feature)*hits->n);
+  if (rank == NULL || start == NULL || f == NULL) {
+    free (rank);
+    free (start);
+    free (f);
+    return -1;
+  }
+
+  // Number the feature indexes in order of their first hit (from 1), and
+  // count the hits of each
+  for (i=0; i<hits->n; i++) {
+    unsigned *r = &rank[hits->f[i].feature_index];
+    if (*r == 0)
+      *r = ++nranks;
+    start[*r]++;
+  }
+  for (i=1; i<=nranks; i++)
+    start[i] += start[i-1];
+  for (i=0; i<hits->n; i++)
+    f[start[rank[hits->f[i].feature_index]-1]++] = hits->f[i];
+
+  free (rank);
+  free (start);
+  free (hits->f);
+  hits->f = f;
+  hits->size = hits->n;
+  return 0;
+}
+
+static void
+print_end (void)
+{
+  struct feature end = { FRAGS_END, FRAGS_END, FRAGS_END, FRAGS_END };
+  if (binary_output)
+    fwrite (&end, sizeof (struct feature), 1, stdout);
+}
 
 void
-get_frags (char *file, FILE *fp)
-{
-  int c;
-  int n = 0;
-  int n2 = 0;
-  int idx = 0;
-  char s[MAXSEQLEN+1];
-  char s2[2*MAXSEQLEN+1];
-  void *v;
-
-  while ((c = fgetc (fp)) != EOF && n < MAXSEQLEN) {
-    // XXX: we don't handle wildcards yet
-    if (toupper (c) == '*' || toupper (c) == 'N')
-      c = 'A';
-    else if (c == ' ' || c == '\n')
+get_frags (struct frags_db *db, char *file, FILE *fp)
+{
+  char buf[CHUNK_SIZE];
+  size_t n;
+  struct scan_state st;
+  struct frags_hits hits = { NULL, 0, 0 };
+
+  if (!binary_output)
+    printf ("====== %s\n", file);
+
+  if (scan_start (db, &st) < 0) {
+    fprintf (stderr, "%s: out of memory\n", file);
+    scan_free (&st);
+    return;
+  }
+  while ((n = fread (buf, 1, CHUNK_SIZE, fp)) > 0) {
+    if (scan_feed (db, &st, buf, n, &hits) < 0) {
+      fprintf (stderr, "%s: out of memory\n", file);
+      break;
+    }
+    if (!grouped_output)
+      print_hits (&hits);
+  }
+  if (scan_finish (db, &st, &hits) < 0)
+    fprintf (stderr, "%s: out of memory\n", file);
+  if (grouped_output && group_hits (&hits) < 0)
+    fprintf (stderr, "%s: out of memory\n", file);
+  print_hits (&hits);
+  print_end ();
+  scan_free (&st);
+  free (hits.f);
+}
+
+/*
+ * Server mode
+ *
+ * frags -s <socket path> [-w <workers>] <blastdata[:threads]...> loads
+ * each feature database once, then serves scan requests over a Unix
+ * socket; a database given as <blastdata>:<n> is scanned with n threads.
+ * A pool of forked workers shares the loaded indexes and accepts
+ * connections; a worker that dies is replaced, so a crash costs one
+ * request, not the server. With "-s -" a single client is served over
+ * stdin/stdout.
+ *
+ * On SIGHUP the server loads every feature database again from its file,
+ * keeping the old one if that fails, and replaces its workers with ones
+ * that share the new indexes; send it after rebuilding the databases
+ * (fixtures/mk_db.sh). A request a replaced worker was serving fails and
+ * is retried by the client on a new connection.
+ *
+ * A connection carries any number of requests. All integers are unsigned
+ * 32 bit, in network byte order.
+ *
+ *   request:   <name length> <database name>
+ *              <sequence length> <sequence>
+ *   response:  <number of frags n> n * <feature index> <fragment index>
+ *                                       <start position> <shift>
+ *         or:  0xffffffff <message length> <message>
+ *
+ * The database name is the .data or .idx file name without the extension.
+ */
+
+#define FRAGS_ERROR 0xffffffff
+#define MAX_NAME_LEN 1024
+#define DEFAULT_WORKERS 4
+
+struct frags_server_db {
+  char name[MAX_NAME_LEN+1];
+  const char *file;
+  struct frags_db *db;
+  int nthreads;
+};
+
+static int
+read_full (int fd, void *buf, size_t n)
+{
+  char *p = (char *) buf;
+  while (n > 0) {
+    ssize_t r = read (fd, p, n);
+    if (r < 0 && errno == EINTR)
+      continue;
+    if (r <= 0)
+      return -1;
+    p += r;
+    n -= r;
+  }
+  return 0;
+}
+
+static int
+write_full (int fd, const void *buf, size_t n)
+{
+  const char *p = (const char *) buf;
+  while (n > 0) {
+    ssize_t r = write (fd, p, n);
+    if (r < 0 && errno == EINTR)
+      continue;
+    if (r <= 0)
+      return -1;
+    p += r;
+    n -= r;
+  }
+  return 0;
+}
+
+static int
+read_u32 (int fd, unsigned *v)
+{
+  uint32_t x;
+  if (read_full (fd, &x, sizeof (x)) < 0)
+    return -1;
+  *v = ntohl (x);
+  return 0;
+}
+
+static int
+write_error (int fd, const char *msg)
+{
+  uint32_t x[2];
+  x[0] = htonl (FRAGS_ERROR);
+  x[1] = htonl (strlen (msg));
+  if (write_full (fd, x, sizeof (x)) < 0)
+    return -1;
+  return write_full (fd, msg, strlen (msg));
+}
+
+static int
+write_hits (int fd, struct feature *f, unsigned n)
+{
+  uint32_t buf[4*256];
+  unsigned i, j;
+  uint32_t x = htonl (n);
+  if (write_full (fd, &x, sizeof (x)) < 0)
+    return -1;
+  for (i=0; i<n; i+=j) {
+    for (j=0; j<256 && i+j<n; j++) {
+      buf[4*j] = htonl (f[i+j].feature_index);
+      buf[4*j+1] = htonl (f[i+j].fragment_index);
+      buf[4*j+2] = htonl (f[i+j].position);
+      buf[4*j+3] = htonl (f[i+j].shift);
+    }
+    if (write_full (fd, buf, sizeof (uint32_t)*4*j) < 0)
+      return -1;
+  }
+  return 0;
+}
+
+// Answers requests on a connection until the client hangs up.
+static void
+serve_connection (struct frags_server_db *dbs, int ndbs, int in, int out)
+{
+  char name[MAX_NAME_LEN+1];
+  unsigned len;
+
+  while (read_u32 (in, &len) == 0) {
+    struct frags_server_db *sdb = NULL;
+    struct feature *f;
+    char *seq;
+    int i, n;
+
+    if (len > MAX_NAME_LEN || read_full (in, name, len) < 0)
+      return;
+    name[len] = '\0';
+    if (read_u32 (in, &len) < 0)
+      return;
+    seq = (char *) malloc (len+1);
+    if (seq == NULL) {
+      write_error (out, "sequence too long");
+      return;
+    }
+    if (read_full (in, seq, len) < 0) {
+      free (seq);
+      return;
+    }
+
+    for (i=0; i<ndbs; i++)
+      if (strcmp (dbs[i].name, name) == 0)
+        sdb = &dbs[i];
+    if (sdb == NULL) {
+      free (seq);
+      if (write_error (out, "unknown feature database") < 0)
+        return;
+      continue;
+    }
+
+    n = frags_scan_threads (sdb->db, seq, len, sdb->nthreads, &f);
+    free (seq);
+    if (n < 0) {
+      if (write_error (out, "out of memory") < 0)
+        return;
       continue;
-    else if (toupper (c) != 'A' && toupper (c) != 'G' &&
-	         toupper (c) != 'C' && toupper (c) != 'T') {
-      c = 'A';
-      // fprintf (stderr, "%s cut off at pos %d (%d)\n", file, n, c);
-      // break;
     }
-    s[n] = toupper (c); 
-    n++;
+    i = write_hits (out, f, n);
+    frags_free_hits (f);
+    if (i < 0)
+      return;
   }
-  s[n] = '\0';
-  if (c != EOF && n >= MAXSEQLEN)
-    fprintf (stderr, "%s cut off at %d (max)\n", file, n);
+}
 
-  printf ("======%d %s\n", n, file);
+static void
+serve_worker (struct frags_server_db *dbs, int ndbs, int sock)
+{
+  while (1) {
+    int conn = accept (sock, NULL, NULL);
+    if (conn < 0) {
+      if (errno == EINTR || errno == ECONNABORTED)
+        continue;
+      perror ("accept");
+      exit (1);
+    }
+    serve_connection (dbs, ndbs, conn, conn);
+    close (conn);
+  }
+}
 
-  s2[0] = '\0';
-  strcat (s2, s);
-  strcat (s2, s);
-  n2 = n+n;
+static pid_t *workers;
+static int nworkers_running;
 
-  v = get_iterator_data ();
-  while (idx >= 0) {
-    struct feature f;
-    idx = iterate (s2, n2, idx, v, &f);
-    if (idx >= 0 && f.position<n2)
-      printf ("%d %d %d %d\n",
-	      f.feature_index, f.fragment_index, f.position+1, f.shift);
+static pid_t
+spawn_worker (struct frags_server_db *dbs, int ndbs, int sock)
+{
+  pid_t pid = fork ();
+  if (pid == 0) {
+    signal (SIGTERM, SIG_DFL);
+    signal (SIGINT, SIG_DFL);
+    signal (SIGHUP, SIG_IGN);
+    serve_worker (dbs, ndbs, sock);
+    exit (0);
+  }
+  return pid;
+}
+
+static void
+stop_workers (int sig)
+{
+  int i;
+  for (i=0; i<nworkers_running; i++)
+    if (workers[i] > 0)
+      kill (workers[i], SIGTERM);
+  signal (sig, SIG_DFL);
+  raise (sig);
+}
+
+static volatile sig_atomic_t reload_requested;
+
+static void
+request_reload (int sig)
+{
+  reload_requested = 1;
+}
+
+// Loads the feature databases again, then replaces the workers, which
+// still have the old ones.
+static void
+reload_dbs (struct frags_server_db *dbs, int ndbs)
+{
+  int i;
+  for (i=0; i<ndbs; i++) {
+    struct frags_db *db = frags_load (dbs[i].file);
+    if (db == NULL) {
+      fprintf (stderr, "%s: cannot load feature index, keeping the old one\n",
+               dbs[i].file);
+      continue;
+    }
+    frags_free (dbs[i].db);
+    dbs[i].db = db;
   }
-  free_iterator_data (v);
+  for (i=0; i<nworkers_running; i++)
+    if (workers[i] > 0)
+      kill (workers[i], SIGTERM);
+}
+
+static int
+serve (const char *path, int nworkers, char **files, int nfiles)
+{
+  struct frags_server_db *dbs;
+  struct sockaddr_un addr;
+  struct sigaction hup;
+  int i, sock;
+
+  dbs = (struct frags_server_db *)
+    malloc (sizeof (struct frags_server_db)*nfiles);
+  for (i=0; i<nfiles; i++) {
+    const char *base;
+    char *ext;
+    // <blastdata>:<n> scans that database's requests with n threads
+    dbs[i].nthreads = 1;
+    ext = strrchr (files[i], ':');
+    if (ext) {
+      dbs[i].nthreads = atoi (ext+1);
+      *ext = '\0';
+    }
+    base = strrchr (files[i], '/');
+    base = base ? base+1 : files[i];
+    strncpy (dbs[i].name, base, MAX_NAME_LEN);
+    dbs[i].name[MAX_NAME_LEN] = '\0';
+    ext = strrchr (dbs[i].name, '.');
+    if (ext && (strcmp (ext, ".data") == 0 || strcmp (ext, ".idx") == 0))
+      *ext = '\0';
+    dbs[i].file = files[i];
+    dbs[i].db = frags_load (files[i]);
+    if (dbs[i].db == NULL) {
+      fprintf (stderr, "%s: cannot load feature index\n", files[i]);
+      return 1;
+    }
+  }
+
+  signal (SIGPIPE, SIG_IGN);
+
+  if (strcmp (path, "-") == 0) {
+    serve_connection (dbs, nfiles, 0, 1);
+    return 0;
+  }
+
+  if (strlen (path) >= sizeof (addr.sun_path)) {
+    fprintf (stderr, "%s: socket path too long\n", path);
+    return 1;
+  }
+  sock = socket (AF_UNIX, SOCK_STREAM, 0);
+  memset (&addr, 0, sizeof (addr));
+  addr.sun_family = AF_UNIX;
+  strcpy (addr.sun_path, path);
+  unlink (path);
+  if (sock < 0 ||
+      bind (sock, (struct sockaddr *) &addr, sizeof (addr)) < 0 ||
+      listen (sock, 128) < 0) {
+    perror (path);
+    return 1;
+  }
+
+  // Without SA_RESTART, so that SIGHUP interrupts wait() below
+  memset (&hup, 0, sizeof (hup));
+  hup.sa_handler = request_reload;
+  sigemptyset (&hup.sa_mask);
+  sigaction (SIGHUP, &hup, NULL);
+
+  workers = (pid_t *) malloc (sizeof (pid_t)*nworkers);
+  for (i=0; i<nworkers; i++)
+    workers[i] = spawn_worker (dbs, nfiles, sock);
+  nworkers_running = nworkers;
+  signal (SIGTERM, stop_workers);
+  signal (SIGINT, stop_workers);
+
+  while (1) {
+    int status;
+    pid_t pid;
+    if (reload_requested) {
+      reload_requested = 0;
+      fprintf (stderr, "frags reloading feature databases\n");
+      reload_dbs (dbs, nfiles);
+    }
+    pid = wait (&status);
+    if (pid < 0) {
+      if (errno == EINTR)
+        continue;
+      break;
+    }
+    fprintf (stderr, "frags worker %d exited, restarting\n", (int) pid);
+    for (i=0; i<nworkers; i++)
+      if (workers[i] == pid)
+        workers[i] = spawn_worker (dbs, nfiles, sock);
+  }
+  return 0;
+}
+
+static void
+usage (const char *prog)
+{
+  fprintf (stderr, "usage: %s [-b] [-g] <blastdata> <sequence files|-...>\n",
+           prog);
+  fprintf (stderr, "       %s -s <socket|-> [-w <workers>] "
+                   "<blastdata[:threads]...>\n", prog);
 }
 
 int
 main (int argc, char *argv[])
 {
   unsigned i;
+  struct frags_db *db;
+  if (argc >= 2 && strcmp (argv[1], "-s") == 0) {
+    int nworkers = DEFAULT_WORKERS;
+    int first = 3;
+    if (argc >= 5 && strcmp (argv[3], "-w") == 0) {
+      nworkers = atoi (argv[4]);
+      first = 5;
+    }
+    if (argc <= first || nworkers < 1) {
+      usage (argv[0]);
+      return 1;
+    }
+    return serve (argv[2], nworkers, argv+first, argc-first);
+  }
+  while (argc >= 2 && (strcmp (argv[1], "-b") == 0 ||
+                       strcmp (argv[1], "-g") == 0)) {
+    if (argv[1][1] == 'b')
+      binary_output = 1;
+    else
+      grouped_output = 1;
+    argv[1] = argv[0];
+    argv++;
+    argc--;
+  }
   if (argc < 3) {
-    fprintf (stderr, "usage: %s <blastdata> <sequence files...>\n", argv [0]);
+    usage (argv[0]);
+    return 1;
+  }
+  db = frags_load (argv[1]);
+  if (db == NULL) {
+    fprintf (stderr, "%s: cannot load feature index\n", argv[1]);
     return 1;
   }
-  load_features (argv[1]);
   for (i=2; i<argc; i++) {
-    FILE *fp = fopen (argv[i], "r");
+    FILE *fp = strcmp (argv[i], "-") == 0 ? stdin : fopen (argv[i], "r");
     if (fp == NULL)
       continue;
-    get_frags (argv[i], fp);
-    fclose (fp);
+    get_frags (db, argv[i], fp);
+    if (fp != stdin)
+      fclose (fp);
   }
+  frags_free (db);
   return 0;
 }
 
+#endif
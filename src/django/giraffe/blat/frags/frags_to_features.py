@@ -10,23 +10,45 @@
 ##############################################################################
 ## Imports
 from __future__ import division
-from copy import deepcopy
+import array
+import multiprocessing
+import threading
+from bisect import bisect_left, bisect_right
+from heapq import heapify, heappop, heappush
 from operator import attrgetter
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+
+from giraffe.blat.catalog import get_catalog
 from giraffe.blat.models import Feature_Type
-from giraffe.blat.models import Feature_DB_Index
 from giraffe.blat.models import Sequence_Feature
 
 ##############################################################################
 ## Global Constants
 PCT_IDENTITY_ERROR_THRESHOLD = 0.25
 WT_THRESHOLD = 0.05
+BEAM_WIDTH = 64 # Trains of a feature index that may be extended at once
+DROP_DOMINATED = False # Whether to drop trains dominated by a copy
+POOL_MIN_LENGTH = 100000 # Shortest sequence to build trains for in a pool
 
 ##############################################################################
 ## Flags
 _debug = False
 _debug_features_to_observe = (98, 132)
 
+##############################################################################
+## Counters
+_pruning_counts = {
+    'dominated' : 0, # trains dropped for a better train of the same frags
+    'beam'      : 0, # trains no longer extended to keep within the beam
+    'hopeless'  : 0, # feature indexes whose frags could make no good train
+}
+
 ##############################################################################
 ## Classes
 class FeatureData(object):
@@ -39,6 +61,13 @@ class FeatureData(object):
         self.__length = len(self.__feature.sequence)
         self.__clockwise = not fdb.antisense
 
+    def __getstate__(self):
+        # Pool processes are sent the feature data without the db rows
+        state = self.__dict__.copy()
+        state['_FeatureData__fdb'] = None
+        state['_FeatureData__feature'] = None
+        return state
+
     ## Accessors
     @property
     def type(self):
@@ -71,23 +100,17 @@ class Frag(object):
     ## Constants
     SIZE = 12 # The size of an individual fragment, in bases
 
-    def __init__(self, string = None, feature_index = -1, fragment_index = -1, 
+    # A sequence can have millions of frags: keep them small
+    __slots__ = ('__feature_index', '__fragment_index',
+                 '__seq_start_position', '__shift')
+
+    def __init__(self, feature_index = -1, fragment_index = -1, 
             seq_start_position = -1, shift = 0):
-        """ Create a fragment, either from a string or from the data itself. """
-        if string == None:
-            # Create from given arguments
-            self.__feature_index  = feature_index
-            self.__fragment_index = fragment_index
-            self.__seq_start_position = seq_start_position
-            self.__shift = shift
-        else:
-            # Parse a line of text (faster witout regexp)
-            # to make the frag object
-            frag_list = string.split()
-            if len(frag_list) != 4: raise ValueError
-            (self.__feature_index, self.__fragment_index, 
-             self.__seq_start_position, self.__shift) = \
-                  [ int(num) for num in frag_list ]
+        """ Create a fragment from the data the scanner reports. """
+        self.__feature_index  = feature_index
+        self.__fragment_index = fragment_index
+        self.__seq_start_position = seq_start_position
+        self.__shift = shift
 
         # Incorporate the shift into the position at the beginning
         if self.__shift > 0:
@@ -107,6 +130,16 @@ class Frag(object):
     def shift(self):
         return self.__shift
 
+    ## Conversion methods
+    def to_record(self):
+        """ Returns the (feature index, fragment index, start position,
+        shift) record the scanner reported the fragment as. """
+        position = self.__seq_start_position
+        if self.__shift > 0:
+            position -= self.__shift
+        return (self.__feature_index, self.__fragment_index, position,
+                self.__shift)
+
     ## Overloaded operators
     def __repr__(self):
         return 'Frag("%d %d %d %d")' % (self.feature_index,
@@ -128,6 +161,11 @@ class FragTrain(object):
     Contains of a list of Frags, counts of the hits, mutations, intserts, and
     deletes encountered by those frags, and methods to manipulate the data. Also
     contains information about the feature (such as its length).
+
+    The Frags are kept as a chain of (frag, previous link) pairs, newest
+    first, so trains copied from one another share the frags they had in
+    common: copying a train is O(1), and extending a copy leaves the
+    original alone.
     """
 
     ## Constants
@@ -135,6 +173,10 @@ class FragTrain(object):
                                # matched to be high-fidelity
     MAX_INSERT_FRACTION = 0.75
 
+    __slots__ = ('hits', 'short', 'mutations', 'inserts', 'deletes', 'score',
+                 '__feature_data', '__head', '__last', '__length',
+                 '__left_position', '__stop_position', '__is_high_fidelity')
+
 
     def __init__(self, feature_data, 
             frags = None, hits = 0, short = False, mutations = 0,
@@ -152,7 +194,9 @@ class FragTrain(object):
         self.__feature_data = feature_data
 
         # Keep the internals hidden
-        self.__train = []
+        self.__head = None
+        self.__last = None
+        self.__length = 0
         if frags != None:
             self.__make_train(frags)
 
@@ -169,11 +213,11 @@ class FragTrain(object):
     # For read-only train access
     @property
     def head(self):
-        return self.__train[0]
+        return self.__head
 
     @property
     def tail(self):
-        return self.__train[-1]
+        return self.__last[0]
 
     ## Calculated properties
     @property
@@ -235,22 +279,51 @@ class FragTrain(object):
     ## Action methods
     def extend(self, frag, add_hits = True):
         """ Adds one fragment to the end of the train. """
-        self.__train.append(frag)
+        if not self.__length:
+            self.__head = frag
+        self.__last = (frag, self.__last)
+        self.__length += 1
 
         if add_hits:
             self.hits += self.__calculate_hit_score(frag)
 
+    def clone(self):
+        """
+        Returns a copy of the train, with the same counts, that shares its
+        Frags with this one.
+        """
+        new_train = FragTrain.__new__(FragTrain)
+        new_train.hits = self.hits
+        new_train.short = self.short
+        new_train.mutations = self.mutations
+        new_train.inserts = self.inserts
+        new_train.deletes = self.deletes
+        new_train.__feature_data = self.__feature_data
+        new_train.__head = self.__head
+        new_train.__last = self.__last
+        new_train.__length = self.__length
+        return new_train
+
     def __deepcopy__(self, memo):
         # Don't want true deep copy: __feature_data stays shallow, as
-        # do the Frags in the __train itself
-        new_train = FragTrain(self.__feature_data,  hits=self.hits,
-                              short=self.short,     mutations=self.mutations,
-                              inserts=self.inserts, deletes=self.deletes,
-                              frags=self.__train)
-
-        return new_train
+        # do the Frags in the train itself
+        return self.clone()
 
     ## Comparison methods
+    def has_same_frags(self, other_train):
+        """ Checks whether two trains are made of the very same Frags. """
+        if self.__length != other_train.__length:
+            return False
+        link = self.__last
+        other_link = other_train.__last
+        # Copies share the links they had in common, so this stops there
+        while link is not other_link:
+            if link[0] is not other_link[0]:
+                return False
+            link = link[1]
+            other_link = other_link[1]
+        return True
+
     def overlaps_with_preceeding(self, preceeding_train):
         """ 
         Checks for overlap with a train of the same feature that starts in the 
@@ -333,17 +406,49 @@ class FragTrain(object):
         #  XXX END FeatureType-Dependent Code
         return seq_feat
 
+    def summary(self):
+        """
+        Returns the train's counts and its fragments' packed records, to
+        send it to another process; see from_summary.
+        """
+        records = array.array('I')
+        for frag in self.__frags():
+            records.extend(frag.to_record())
+        return (self.hits, self.short, self.mutations, self.inserts,
+                self.deletes, records)
+
+    @staticmethod
+    def from_summary(feature_data, summary):
+        """ Makes the train that summary() returned the summary of. """
+        (hits, short, mutations, inserts, deletes, records) = summary
+        train = FragTrain(feature_data, short = short, mutations = mutations,
+                          inserts = inserts, deletes = deletes,
+                          frags = [Frag(*records[fx:fx+4])
+                                   for fx in xrange(0, len(records), 4)])
+        train.hits = hits
+        return train
+
     ## Overloaded operators
     def __repr__(self):
-        return '[' + ' '.join([repr(frag) for frag in self.__train]) + ']'
+        return '[' + ' '.join([repr(frag) for frag in self.__frags()]) + ']'
 
     def __str__(self):
-        return '[' + ' '.join([str(frag) for frag in self.__train]) + ']'
+        return '[' + ' '.join([str(frag) for frag in self.__frags()]) + ']'
 
     def __len__(self):
-        return len(self.__train)
+        return self.__length
             
     ## Private utility methods
+    def __frags(self):
+        """ Returns the list of Frags in the train, head first. """
+        frags = []
+        link = self.__last
+        while link is not None:
+            (frag, link) = link
+            frags.append(frag)
+        frags.reverse()
+        return frags
+
     def __make_train(self, frags):
         add_hits = (self.hits == 0) # only add in the hits if we have no
                                     # hit score yet
@@ -436,6 +541,9 @@ class FragTrain(object):
 class FragTrainLink(object):
     """ Links a Frag to a FragTrain, temporarily or permanently. """
 
+    __slots__ = ('frag', 'train', 'frag_index_diff', 'seq_pos_diff',
+                 '__insert_size')
+
     def __init__(self, frag, train):
         self.frag = frag
         self.train = train
@@ -560,32 +668,354 @@ class FragTrainLink(object):
 
 ##############################################################################
 ## Global Functions
-def _group_frags_by_feature_index(frags_strings):
-    """ Parse the frag strings and group the fragments. """
-    frags_by_feature = {}
+def _group_frags_by_feature_index(frags):
+    """
+    Make Frags from the scanner's packed records and group the fragments
+    by feature index. Returns (feature index, frags) pairs, in order of
+    each group's first frag, keeping the scanner's order within a group.
+    """
+    if numpy is None or not frags:
+        frags_by_feature = {}
+        feature_indexes = []
+        for fx in xrange(0, len(frags), 4):
+            frag = Frag(*frags[fx:fx+4])
+
+            # Hash the frags together by feature index
+            if frag.feature_index in frags_by_feature:
+                frags_by_feature[frag.feature_index].append(frag)
+            else:
+                frags_by_feature[frag.feature_index] = [frag]
+                feature_indexes.append(frag.feature_index)
+        return [(fi, frags_by_feature[fi]) for fi in feature_indexes]
 
-    for fx, feature_frag_line in enumerate(frags_strings):
-        # Make a feature from the line of text
-        try:
-            frag = Frag(string = feature_frag_line)
-        except ValueError:
-            continue
+    records = numpy.frombuffer(frags, dtype=numpy.uint32).reshape(-1, 4)
+
+    # A stable sort by feature index, then split where it changes
+    order = numpy.argsort(records[:, 0], kind='mergesort')
+    records = records[order]
+    starts = numpy.flatnonzero(numpy.diff(records[:, 0])) + 1
+    starts = numpy.concatenate(([0], starts))
+    ends = numpy.concatenate((starts[1:], [len(records)]))
+
+    return [(int(records[start, 0]),
+             [Frag(*r) for r in records[start:end].tolist()])
+            for start, end in sorted(zip(starts, ends),
+                                     key=lambda g: order[g[0]])]
+
+def _group_frag_stream(chunks):
+    """
+    Make Frags from chunks of packed records that are already grouped by
+    feature index (frags -g), and yield (feature index, frags) pairs, each
+    as soon as the next group starts.
+    """
+    feature_index = None
+    group = []
+    for chunk in chunks:
+        for fx in xrange(0, len(chunk), 4):
+            frag = Frag(*chunk[fx:fx+4])
+            if frag.feature_index != feature_index:
+                if group:
+                    yield (feature_index, group)
+                feature_index = frag.feature_index
+                group = []
+            group.append(frag)
+    if group:
+        yield (feature_index, group)
+
+def _link_frag_to_train(frag, train, fx, trains):
+    """
+    Tries to link the fragment at index fx to the train, and extends the
+    train if they link. When hedging an insert or a deletion, a copy of
+    the train is added to trains.
+
+    Returns a tuple: whether the fragment extended the train with a
+    consecutive or mutation link (no new train is needed for it), whether
+    a new train made from the fragment must be short, and the index in
+    trains of the copy added, or None.
+    """
+    link = FragTrainLink(frag, train)
+
+    # First: try to extend consecutive trains
+    if link.is_consecutive():
+        # Solidify the link by extending the train
+        link.solidify()
+
+        if _debug: 
+            if train.feature_index in _debug_features_to_observe:
+                print "extended consecutive train"
+                print train
+
+        return (True, False, None)
+
+    # Second: try to extend trains with inserts/mutations/deletions
+    elif not train.short and link.is_nonoverlapping():
+
+        if link.has_mutation():
+            # Solidify the link by extending the train
+            # and updating the mutation count
+            link.solidify()
+            link.update_mutations()
+
+            if _debug: 
+                if train.feature_index in _debug_features_to_observe:
+                    print "extended train with mutations"
+                    print train
+
+            return (True, False, None)
+
+        # In case the sequence really represents two separate, 
+        # features which we have misread as an insertion/deletion,
+        # we hedge our bets. Whenever we detect an insertion or
+        # a deletion in a train, we add a copy of that train
+        # to the list of trains, and only extend one of the trains.
+        elif link.has_insert():
+            copy_index = None
+            if train.matches():
+                new_train = train.clone()
+                new_train.short = True
+                trains.append(new_train)
+                copy_index = len(trains) - 1
+
+                if _debug: 
+                    if train.feature_index in _debug_features_to_observe:
+                        print "made dupliate train due to inserts"
+                        print train
+
+
+            # Solidify the link by extending the train
+            # and updating the insert and/or mutation count
+            link.solidify()
+            link.update_inserts()
+            
+            if _debug: 
+                if train.feature_index in _debug_features_to_observe:
+                    print "extended train with inserts"
+                    print train
 
-        # Hash the frags together by feature index
-        if frag.feature_index in frags_by_feature:
-            frags_by_feature[frag.feature_index].append(frag)
+            return (False, True, copy_index)
+
+        # Link has deletion
         else:
-            frags_by_feature[frag.feature_index] = [frag]
+            # For deletions, use a "hypothetical" train, with the
+            # maximum possible number of hits
+            hypo_train = link.make_hypo_train()
+            # XXX I don't understand why this has to be the case
+
+            if hypo_train.matches():
+                # Append an identical copy of the train in its current
+                # state to the beginning of the train list.  We need to
+                # insert the new, identical copy before the iterator, so
+                # that it doesn't get iterated over again, or else an
+                # infinite loop results in certain cases
+                new_train = train.clone()
+                copy_index = min(fx, len(trains))
+                trains.insert(fx, new_train)
+
+                # Solidify the link by extending the train
+                # and updating the delete count
+                link.solidify()
+                link.update_deletes()
+
+                if _debug: 
+                    if train.feature_index in _debug_features_to_observe:
+                        print "extended train with deletes"
+                        print train
+
+                return (False, False, copy_index)
+
+            # The order of trains should therefore have the same
+            # properites as the order of trains in the perl code.
+
+    return (False, False, None)
+
+def _new_train(frag, feature_data, seq_length, short, trains):
+    """
+    Appends a train made from the fragment to trains; returns whether it
+    did.
+    """
+    if frag.seq_start_position <= seq_length:
+        if _debug: 
+            if frag.feature_index in _debug_features_to_observe:
+                if short:
+                    print "new short train"
+                else:
+                    print "new train"
+                print frag
 
-    return frags_by_feature
+        trains.append(FragTrain(feature_data, frags = [frag], \
+                                short = short))
+        return True
+    return False
 
-def _frags_to_trains(frags, feature_data, seq_length):
+class _TrainWindow(object):
+    """
+    The trains that a fragment may still extend, for _frags_to_trains.
+
+    Only trains that are not short, and end before the fragment, can be
+    extended. Past some distance from the end of a train, which depends
+    on the train (see reach), no link to it can be a mutation or an
+    insert, nor a deletion whose hypothetical train matches; fragments
+    are scanned in sequence order, so the train is then done for good.
+
+    The trains a fragment may extend have to be tried in the order they
+    have in the list of trains, which copies are inserted into as the
+    trains are tried. Every train gets an order key, sorting like the
+    list, so the window's trains can be tried in that order.
+    """
+
+    GAP = 1 << 16
+
+    def __init__(self, feature_data, frags, trains, beam_width = None):
+        self.trains = trains
+        self.beam_width = beam_width
+        self.__length = feature_data.length
+        self.__nfrags = max(int((feature_data.length - 1)/Frag.SIZE),
+                            max(frag.fragment_index for frag in frags)) + 1
+        self.__keys = {}
+        self.__ends = {}
+        self.__active = []
+
+    def reach(self, train):
+        """
+        How far past its last fragment a fragment can still link to the
+        train. See FragTrainLink: mutations and inserts are at most the
+        length of the feature away, and a deletion's hypothetical train
+        cannot match once the deletion costs more than the train's best
+        possible hits. Rounded up generously.
+        """
+        L = self.__length
+        best_hits = Frag.SIZE * (len(train) + 1) + L
+        return max(Frag.SIZE * self.__nfrags, int(L * FragTrain.MAX_INSERT_FRACTION),
+                   10 * (best_hits + 0.3 * train.mutations - 0.75 * L) +
+                   Frag.SIZE * self.__nfrags) + 2 * Frag.SIZE
+
+    def added(self, index):
+        """ Notes the train just added at the index of trains. """
+        trains = self.trains
+        train = trains[index]
+        if index + 1 == len(trains):
+            key = self.__keys[id(trains[index-1])] + self.GAP if index else 0
+        elif index == 0:
+            key = self.__keys[id(trains[1])] - self.GAP
+        else:
+            lo = self.__keys[id(trains[index-1])]
+            hi = self.__keys[id(trains[index+1])]
+            key = (lo + hi) // 2
+            if key == lo:
+                self.__renumber()
+                lo = self.__keys[id(trains[index-1])]
+                hi = self.__keys[id(trains[index+1])]
+                key = (lo + hi) // 2
+        self.__keys[id(train)] = key
+        if not train.short:
+            self.__active.append(train)
+            self.update(train)
+
+    def update(self, train):
+        """ Notes that the train was extended. """
+        self.__ends[id(train)] = train.tail.seq_start_position + Frag.SIZE + \
+                                 self.reach(train)
+
+    def key(self, train):
+        return self.__keys[id(train)]
+
+    def candidates(self, frag):
+        """
+        Returns the trains the fragment may extend, by order key; drops
+        the trains no later fragment can extend.
+        """
+        scanned = frag.seq_start_position - frag.shift
+        ends = self.__ends
+        self.__active = [t for t in self.__active if ends[id(t)] > scanned]
+        if self.beam_width and len(self.__active) > self.beam_width:
+            self.__narrow()
+        return [t for t in self.__active
+                if t.tail.fragment_index < frag.fragment_index and
+                   t.tail.seq_start_position + Frag.SIZE <= frag.seq_start_position]
+
+    def dropped(self, dropped):
+        """ Stops extending the trains whose ids are in dropped. """
+        self.__active = [t for t in self.__active if id(t) not in dropped]
+
+    def __narrow(self):
+        """
+        Keeps extending only the beam_width best scoring trains, earliest
+        in the list first on ties.
+        """
+        for train in self.__active:
+            train.matches()
+        keys = self.__keys
+        ranked = sorted(self.__active,
+                        key=lambda t: (t.score, keys[id(t)]))
+        _pruning_counts['beam'] += len(ranked) - self.beam_width
+        self.__active = ranked[:self.beam_width]
+
+    def __renumber(self):
+        for (i, train) in enumerate(self.trains):
+            if id(train) in self.__keys:
+                self.__keys[id(train)] = i * self.GAP
+
+def _dominates(train, other_train):
+    """
+    Checks whether a train is at least as good as another in every count
+    that linking fragments and matching look at.
+    """
+    return train.hits >= other_train.hits and \
+           train.mutations >= other_train.mutations and \
+           train.inserts <= other_train.inserts and \
+           train.deletes <= other_train.deletes and \
+           len(train) >= len(other_train)
+
+def _dominated(extended):
+    """
+    Of the trains just extended by the same fragment (in list order),
+    finds those made of the same frags as an earlier one, as short, and
+    dominated by it: the earlier one makes every link they make, with
+    counts at least as good.
+
+    Returns the set of the ids of the dominated trains. They are to be
+    left in the list of trains until all the fragments are linked, as
+    where hedged copies go depends on the length of the list.
+
+    Dropping them can still change the features found: the dominated
+    copies would have gone on to make trains of their own, at other
+    places in the list, and which trains _pick_good_trains keeps depends
+    on those places. Hence settings.FRAGS_DROP_DOMINATED, off by default.
+    """
+    if len(extended) < 2:
+        return ()
+
+    same_span = {}
+    for train in extended:
+        same_span.setdefault((id(train.head), train.short), []).append(train)
+
+    dropped = set()
+    for same in same_span.itervalues():
+        for (i, train) in enumerate(same):
+            if id(train) in dropped:
+                continue
+            for other_train in same[i+1:]:
+                if id(other_train) not in dropped and \
+                   train.has_same_frags(other_train) and \
+                   _dominates(train, other_train):
+                    dropped.add(id(other_train))
+
+    _pruning_counts['dominated'] += len(dropped)
+    return dropped
+
+def _frags_to_trains(frags, feature_data, seq_length, beam_width = None,
+                     drop_dominated = False):
     """
     Converts a list of fragments (of a single feature index) into a list of
     trains of fragments, which are candidates for feature identification.
 
     Arguments:
         frags         --- the list of fragments
+        beam_width    --- how many trains may be extended at once; the
+                          worst scoring ones are left as they are beyond
+                          that (None for no limit)
+        drop_dominated --- whether to drop the trains dominated by a copy
+                          made of the same frags, see _dominated
     """
     if _debug: 
         if frags[0].feature_index in _debug_features_to_observe:
@@ -593,7 +1023,38 @@ def _frags_to_trains(frags, feature_data, seq_length):
             for frag in frags:
                 print frag
 
+    # Consecutive links are only told apart from mutations when
+    # debugging, and can extend short trains, so the window does not
+    # apply. Neither does it if the fragments are out of sequence order.
+    in_order = all(frags[i].seq_start_position - frags[i].shift <=
+                   frags[i+1].seq_start_position - frags[i+1].shift
+                   for i in xrange(len(frags) - 1))
+    if _debug or not in_order:
+        trains = _frags_to_trains_by_trying_all(frags, feature_data,
+                                                seq_length, drop_dominated)
+    else:
+        trains = _frags_to_trains_by_window(frags, feature_data, seq_length,
+                                            beam_width, drop_dominated)
+
+    if _debug: 
+        notprint = True
+        for train in trains:
+            if train.feature_index in _debug_features_to_observe:
+                if notprint:
+                    print "--- Trains (%d)" % len(trains)
+                    notprint = False
+                print train
+
+    return trains
+
+def _frags_to_trains_by_trying_all(frags, feature_data, seq_length,
+                                   drop_dominated = False):
+    """
+    Tries to link every fragment to every train, with no beam: used when
+    debugging, and when the fragments are out of order.
+    """
     trains = []
+    dominated = set()
 
     # Main loop: iterate through the list of fragments
     for fx, frag in enumerate(frags):
@@ -605,119 +1066,108 @@ def _frags_to_trains(frags, feature_data, seq_length):
         new_train_is_short = False
 
         for train in trains:
-            link = FragTrainLink(frag, train)
-
-            # First: try to extend consecutive trains
-            if link.is_consecutive():
-                # Solidify the link by extending the train
-                link.solidify()
+            if id(train) in dominated:
+                continue
+            (extended, short, copy_index) = \
+                _link_frag_to_train(frag, train, fx, trains)
+            if extended:
                 create_new_train = False
+            if short:
+                new_train_is_short = True
 
-                if _debug: 
-                    if train.feature_index in _debug_features_to_observe:
-                        print "extended consecutive train"
-                        print train
+        # Make a new train, if necessary
+        if create_new_train: 
+            _new_train(frag, feature_data, seq_length, new_train_is_short,
+                       trains)
 
+        if drop_dominated:
+            dominated.update(_dominated([t for t in trains
+                                         if t.tail is frag and
+                                            id(t) not in dominated]))
 
-            # Second: try to extend trains with inserts/mutations/deletions
-            elif not train.short and link.is_nonoverlapping():
-
-                if link.has_mutation():
-                    # Solidify the link by extending the train
-                    # and updating the mutation count
-                    link.solidify()
-                    link.update_mutations()
-                    create_new_train = False
-
-                    if _debug: 
-                        if train.feature_index in _debug_features_to_observe:
-                            print "extended train with mutations"
-                            print train
-
-
-                # In case the sequence really represents two separate, 
-                # features which we have misread as an insertion/deletion,
-                # we hedge our bets. Whenever we detect an insertion or
-                # a deletion in a train, we add a copy of that train
-                # to the list of trains, and only extend one of the trains.
-                elif link.has_insert():
-                    if train.matches():
-                        new_train = deepcopy(train)
-                        new_train.short = True
-                        trains.append(new_train)
-
-                        if _debug: 
-                            if train.feature_index in _debug_features_to_observe:
-                                print "made dupliate train due to inserts"
-                                print train
-
-
-                    # Solidify the link by extending the train
-                    # and updating the insert and/or mutation count
-                    link.solidify()
-                    link.update_inserts()
-                    new_train_is_short = True
-                    
-                    if _debug: 
-                        if train.feature_index in _debug_features_to_observe:
-                            print "extended train with inserts"
-                            print train
-
-
-                # Link has deletion
-                else:
-                    # For deletions, use a "hypothetical" train, with the
-                    # maximum possible number of hits
-                    hypo_train = link.make_hypo_train()
-                    # XXX I don't understand why this has to be the case
-
-                    if hypo_train.matches():
-                        # Append an identical copy of the train in its current
-                        # state to the beginning of the train list.  We need to
-                        # insert the new, identical copy before the iterator, so
-                        # that it doesn't get iterated over again, or else an
-                        # infinite loop results in certain cases
-                        new_train = deepcopy(train)
-                        trains.insert(fx, new_train)
-
-                        # Solidify the link by extending the train
-                        # and updating the delete count
-                        link.solidify()
-                        link.update_deletes()
-
-                        if _debug: 
-                            if train.feature_index in _debug_features_to_observe:
-                                print "extended train with deletes"
-                                print train
-
-
-                    # The order of trains should therefore have the same
-                    # properites as the order of trains in the perl code.
+    return [t for t in trains if id(t) not in dominated]
+
+def _frags_to_trains_by_window(frags, feature_data, seq_length,
+                               beam_width = None, drop_dominated = False):
+    """
+    Same as _frags_to_trains_by_trying_all, but only tries the trains in
+    the _TrainWindow, in the order the full loop would try them. With a
+    beam_width, only that many trains are tried at most.
+    """
+    trains = []
+    dominated = set()
+    window = _TrainWindow(feature_data, frags, trains, beam_width)
+
+    for fx, frag in enumerate(frags):
+        create_new_train = True
+        new_train_is_short = False
+        linked = []
+
+        todo = [(window.key(t), t) for t in window.candidates(frag)]
+        heapify(todo)
+        while todo:
+            (key, train) = heappop(todo)
+            (extended, short, copy_index) = \
+                _link_frag_to_train(frag, train, fx, trains)
+            if extended:
+                create_new_train = False
+            if short:
+                new_train_is_short = True
+            if copy_index is not None:
+                window.added(copy_index)
+                # Keys may have been renumbered to make room for the copy
+                todo = [(window.key(t), t) for (k, t) in todo]
+                heapify(todo)
+                # The full loop tries a copy inserted after the train
+                # later in the same pass
+                copy = trains[copy_index]
+                if not copy.short and window.key(copy) > window.key(train):
+                    heappush(todo, (window.key(copy), copy))
+            if train.tail is frag:
+                window.update(train)
+                linked.append(train)
 
-        # Make a new train, if necessary
         if create_new_train: 
-            if frag.seq_start_position <= seq_length:
-                if _debug: 
-                    if frag.feature_index in _debug_features_to_observe:
-                        if new_train_is_short:
-                            print "new short train"
-                        else:
-                            print "new train"
-                        print frag
+            if _new_train(frag, feature_data, seq_length, new_train_is_short,
+                          trains):
+                window.added(len(trains) - 1)
 
-                trains.append(FragTrain(feature_data, frags = [frag], \
-                                        short = new_train_is_short))
+        dropped = drop_dominated and _dominated(linked)
+        if dropped:
+            dominated.update(dropped)
+            window.dropped(dropped)
 
-    if _debug: 
-        notprint = True
-        for train in trains:
-            if train.feature_index in _debug_features_to_observe:
-                if notprint:
-                    print "--- Trains (%d)" % len(trains)
-                    notprint = False
-                print train
+    return [t for t in trains if id(t) not in dominated]
 
-    return trains
+def _may_have_good_trains(frags, feature_data):
+    """
+    Checks whether any train of the fragments could be good enough for
+    _pick_good_trains, from the best score a train could have: a train
+    has at most one fragment of each fragment index, and counts at most
+    the bases of the fragment indexes it skips as mutations.
+    """
+    length = feature_data.length
+    hit_indexes = set(frag.fragment_index for frag in frags)
+    nfrags = max(int((length - 1)/Frag.SIZE), max(hit_indexes)) + 1
+    mutated = 0.3 * Frag.SIZE # What FragTrain.matches() scores a fragment
+                              # of mutations
+
+    most_hits = 0
+    most_net_matches = mutated * (nfrags - len(hit_indexes))
+    for fragment_index in hit_indexes:
+        hits = min(Frag.SIZE, length - fragment_index * Frag.SIZE)
+        most_hits += max(hits, 0)
+        most_net_matches += max(hits, mutated)
+
+    #  XXX FeatureType-Dependent Code
+    if feature_data.type == Feature_Type.EXACT_FEATURE or \
+       feature_data.type == Feature_Type.ENZYME:
+        return most_hits >= length
+    if feature_data.type == Feature_Type.GENE and \
+       most_hits >= FragTrain.HIGH_FIDELITY_CUTOFF * length:
+        return True
+    #  XXX End FeatureType-Dependent Code
+    return most_net_matches > (1 - PCT_IDENTITY_ERROR_THRESHOLD) * length - 1
 
 def _pick_good_trains(trains):
     """
@@ -746,84 +1196,300 @@ def _pick_good_trains(trains):
 
     return good_trains
 
+class _OverlapIndex(object):
+    """
+    Finds the best (lowest) score among a set of trains that overlap a
+    given train, as FragTrain.overlaps_with_in_sequence sees it.
+
+    The trains are given sorted by left position. Trains starting inside
+    the queried interval are found with a range-minimum table over the
+    scores; trains starting before it are swept into a heap as the
+    queries move right, and leave it once they stop before the query
+    does. Queries must come in order of left position.
+    """
+
+    def __init__(self, trains):
+        self.__trains = trains
+        self.__lefts = [t.left_position for t in trains]
+
+        # __mins[k][i] is the lowest score of trains i to i + 2^k - 1
+        self.__mins = [[t.score for t in trains]]
+        k = 1
+        while (1 << k) <= len(trains):
+            prev = self.__mins[-1]
+            half = 1 << (k-1)
+            self.__mins.append([min(prev[i], prev[i+half])
+                                for i in xrange(len(prev) - half)])
+            k += 1
+
+        self.__started = []
+        self.__next = 0
+
+    def best_score(self, left, stop):
+        """
+        Returns the lowest score of the trains overlapping [left, stop],
+        or None. left must not be less than in the previous query, and not
+        more than stop.
+        """
+        best = None
+
+        # Trains that start inside the interval
+        lo = bisect_left(self.__lefts, left)
+        hi = bisect_right(self.__lefts, stop)
+        if lo < hi:
+            k = (hi-lo).bit_length() - 1
+            best = min(self.__mins[k][lo], self.__mins[k][hi - (1 << k)])
+
+        # Trains that start before it and reach it
+        while self.__next < len(self.__trains) and \
+              self.__lefts[self.__next] < left:
+            t = self.__trains[self.__next]
+            heappush(self.__started, (t.score, t.stop_position))
+            self.__next += 1
+        while self.__started and self.__started[0][1] < left:
+            heappop(self.__started)
+        if self.__started and (best is None or self.__started[0][0] < best):
+            best = self.__started[0][0]
+
+        return best
+
+
+def _is_pruned(outer_train, trains):
+    """
+    Checks every train that starts before outer_train stops for a better
+    one that overlaps it: any gene, or a feature of the same type with a
+    name containing outer_train's.
+    """
+    for inner_train in trains:
+        if inner_train.left_position > outer_train.stop_position:
+            break
+
+        if (inner_train.feature.type == Feature_Type.GENE or
+            inner_train.has_similar_name(outer_train)) and \
+            inner_train.overlaps_with_in_sequence(outer_train):
+
+            # If the conditions are met, check the scores, and if the 
+            # inner feature scores better, keep it instead of the outer
+            # one
+
+            if inner_train.score < outer_train.score:
+                return True
+    return False
+
 def _trains_to_features(trains, seq_length):
     """
     Prune interleaving trains and make features from the rest.
+
+    A non-enzyme train is pruned if a better train overlaps it, see
+    _is_pruned. Rather than checking every train that starts before it
+    stops, the better trains are looked up in interval indexes: one over
+    all the genes, and one per feature type and name, used for the names
+    containing the train's name.
     """
     features = []
 
     trains.sort(key = attrgetter('left_position'))
 
+    genes = _OverlapIndex([t for t in trains
+                           if t.feature.type == Feature_Type.GENE])
+    by_name = {}
+    for t in trains:
+        by_name.setdefault((t.feature.type, t.feature.name), []).append(t)
+    similar = {}
+    for (type, name) in by_name:
+        similar[(type, name)] = [
+            key for key in by_name if key[0] == type and key[1].find(name) >= 0
+        ]
+    by_name = dict((key, _OverlapIndex(by_name[key])) for key in by_name)
+
     for outer_train in trains:
         add_feature = True
+        left = outer_train.left_position
+        stop = outer_train.stop_position
 
         # XXX FeatureType-Dependent Code
         #     Non-Enzyme features must be pruned.
         if outer_train.feature.type != Feature_Type.ENZYME:
-            for inner_train in trains:
-                if inner_train.left_position > outer_train.stop_position:
-                    break
-
-                if (inner_train.feature.type == Feature_Type.GENE or
-                    inner_train.has_similar_name(outer_train)) and \
-                    inner_train.overlaps_with_in_sequence(outer_train):
-
-                    # If the conditions are met, check the scores, and if the 
-                    # inner feature scores better, keep it instead of the outer
-                    # one
-
-                    if inner_train.score < outer_train.score:
-                        if _debug: print "Pruning %s (%d - %d)" % \
-                            (outer_train.feature.name, 
-                             outer_train.start_position,
-                             outer_train.stop_position)
-
-                        add_feature = False
-                        break
+            if stop < left:
+                add_feature = not _is_pruned(outer_train, trains)
+            else:
+                best = genes.best_score(left, stop)
+                for key in similar[(outer_train.feature.type,
+                                    outer_train.feature.name)]:
+                    score = by_name[key].best_score(left, stop)
+                    if best is None or (score is not None and score < best):
+                        best = score
+                add_feature = best is None or not best < outer_train.score
+
+            if not add_feature and _debug:
+                print "Pruning %s (%d - %d)" % \
+                    (outer_train.feature.name, 
+                     outer_train.start_position,
+                     outer_train.stop_position)
         # else: Enzymes always get added.
         # XXX End FeatureType-Dependent Code
            
-        # If we found a better feature in the inner loop, don't add this outer
-        # feature. When the outer loop gets to the better feature on its own, 
-        # it will add it
+        # If we found a better feature, don't add this one. When the loop
+        # gets to the better feature on its own, it will add it
         if add_feature:
             features.append(outer_train.to_sequence_feature(seq_length))
 
     return features
 
 
-## Main entry point
-def frags_to_features(frags_strings, db, seq_length):
+## Process pool
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool(processes):
+    """ Returns the process-wide pool that builds trains. """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(processes)
+        return _pool
+
+def _build_good_trains(task):
     """
-    Given a list of feature fragments, turns them into Sequence Features.
+    Runs in a pool process: builds and picks the good trains of one
+    group of fragments, sent as packed records. Returns the summaries of
+    the good trains, and what the pruning counts went up by.
     """
+    (feature_data, records, seq_length, beam_width, drop_dominated) = task
+    before = pruning_counts()
 
-    all_trains = [] 
-    
-    # Sort the fragments into groups of the same feature index
-    frags_by_feature_index = _group_frags_by_feature_index(frags_strings)
+    frags = [Frag(*records[fx:fx+4]) for fx in xrange(0, len(records), 4)]
+    good_trains = _pick_good_trains(_frags_to_trains(frags, feature_data,
+                                                     seq_length, beam_width,
+                                                     drop_dominated))
+
+    counts = pruning_counts()
+    return ([train.summary() for train in good_trains],
+            dict((name, counts[name] - before[name]) for name in counts))
+
+def _pick_good_trains_in_pool(groups, seq_length, beam_width, drop_dominated,
+                              processes):
+    """
+    Builds and picks the good trains of each (feature index, FeatureData,
+    list of Frags) group on a pool of processes. Returns (feature index,
+    good trains) pairs, in the order of the groups.
+    """
+    tasks = []
+    for (feature_index, feature_data, frags) in groups:
+        records = array.array('I')
+        for frag in frags:
+            records.extend(frag.to_record())
+        tasks.append((feature_data, records, seq_length, beam_width,
+                      drop_dominated))
+
+    # A few tasks per process, so one slow group does not hold up the rest
+    chunksize = max(1, len(tasks) // (4 * processes))
+    results = _get_pool(processes).map(_build_good_trains, tasks, chunksize)
+
+    picked = []
+    for ((feature_index, feature_data, frags), (summaries, counts)) in \
+            zip(groups, results):
+        good_trains = [FragTrain.from_summary(feature_data, summary)
+                       for summary in summaries]
+        # Sets each train's score, as picking it did
+        for train in good_trains:
+            train.matches()
+        for name in counts:
+            _pruning_counts[name] += counts[name]
+        picked.append((feature_index, good_trains))
+    return picked
+
+
+## Main entry points
+def pruning_counts():
+    """
+    Returns how many trains were dropped as dominated ('dominated'), how
+    many were no longer extended to keep within the beam ('beam'), and
+    how many feature indexes were skipped as their fragments could make
+    no good train ('hopeless'), in this process since the counts were
+    last reset.
+    """
+    return dict(_pruning_counts)
+
+def reset_pruning_counts():
+    for name in _pruning_counts:
+        _pruning_counts[name] = 0
+
+def frag_groups_to_features(frag_groups, db, seq_length):
+    """
+    Given feature fragments grouped by feature index, as (feature index,
+    list of Frags) pairs in order of each group's first fragment, turns
+    them into Sequence Features. frag_groups may be a generator; each
+    group is turned into trains as it comes.
+
+    With settings.FRAGS_PROCESSES above 1, the trains of sequences of at
+    least settings.FRAGS_POOL_MIN_LENGTH bases are built on a pool of
+    that many processes instead, once all the groups have come.
+    """
+
+    # [feature index, good trains] pairs, in the groups' order
+    good_trains_by_group = []
+    catalog = get_catalog(db)
+    beam_width = getattr(settings, 'FRAGS_BEAM_WIDTH', BEAM_WIDTH)
+    drop_dominated = getattr(settings, 'FRAGS_DROP_DOMINATED', DROP_DOMINATED)
+    processes = getattr(settings, 'FRAGS_PROCESSES', 1)
+    pooled = processes > 1 and \
+             seq_length >= getattr(settings, 'FRAGS_POOL_MIN_LENGTH',
+                                   POOL_MIN_LENGTH)
+    pooled_groups = []
+    pooled_positions = {}
 
     # Iterate over each group
-    for (feature_index, single_index_frags) in frags_by_feature_index.items():
+    for (feature_index, single_index_frags) in frag_groups:
+        feature_data = catalog.feature_data(feature_index)
 
-        # Pull the feature data from the DB
-        feature_db = Feature_DB_Index.objects.select_related(
-            'feature', 'feature__type'
-        ).get(
-            feature_index=feature_index,db=db
-        )
+        # Skip the groups that could not make a good train
+        if not _may_have_good_trains(single_index_frags, feature_data):
+            _pruning_counts['hopeless'] += 1
+            continue
+
+        if pooled:
+            # Keep the group's place, for the pool to fill in
+            pooled_positions[feature_index] = len(good_trains_by_group)
+            good_trains_by_group.append([feature_index, None])
+            pooled_groups.append((feature_index, feature_data,
+                                  single_index_frags))
+            continue
 
         # Make the biggest possible trains you can
         single_index_trains  = _frags_to_trains(single_index_frags,
-                                                FeatureData(feature_db),
-                                                seq_length)
+                                                feature_data,
+                                                seq_length, beam_width,
+                                                drop_dominated)
 
         # Prune them to keep only a relevant subset of sufficiently high
         # quality
-        single_index_good_trains = _pick_good_trains(single_index_trains)
-
-        # Add them to the global list
+        good_trains_by_group.append([feature_index,
+                                     _pick_good_trains(single_index_trains)])
+
+    if pooled_groups:
+        for (feature_index, good_trains) in \
+            _pick_good_trains_in_pool(pooled_groups, seq_length, beam_width,
+                                      drop_dominated, processes):
+            good_trains_by_group[pooled_positions[feature_index]][1] = \
+                good_trains
+
+    # Add them to the global list, in the groups' order whatever order
+    # they were processed in
+    all_trains = []
+    for (feature_index, single_index_good_trains) in good_trains_by_group:
         all_trains.extend(single_index_good_trains)
 
     # Turn the global list into a set of non-overlapping SequenceFeature objects
     return _trains_to_features(all_trains, seq_length)
+
+def frags_to_features(frags, db, seq_length):
+    """
+    Given the feature fragments, as an array('I') of (feature index,
+    fragment index, start position, shift) records, turns them into
+    Sequence Features.
+    """
+
+    # Sort the fragments into groups of the same feature index
+    return frag_groups_to_features(_group_frags_by_feature_index(frags),
+                                   db, seq_length)
@@ -0,0 +1,208 @@
+"""
+Pure-NumPy frags scanner, for installs without a C compiler.
+
+Finds the same frags as frags.c, in the same order, but one whole
+sequence at a time: the sequence is 2-bit encoded, every 24-bit k-mer is
+computed at once, and the k-mers are matched against the sorted k-mer
+table with searchsorted. Masked records are matched the same way, one
+mask at a time, against the k-mers ANDed with the mask.
+
+Select it with FRAGS_ENGINE = 'numpy' in settings.
+"""
+
+import array
+import struct
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from giraffe.blat.frags.scanner import index_path
+from giraffe.blat.frags.scanner import index_version
+
+KTUP = 12
+INDEX_MAGIC = 'GFRAGIDX'
+HEADER = '<8s6I'
+
+
+def available():
+    """ Returns True if NumPy can be imported. """
+    return numpy is not None
+
+
+def _base_codes():
+    """
+    Returns the 2-bit code of each byte, and whether the byte is skipped,
+    as normalize_base and scan_bases in frags.c see it: spaces and
+    newlines are skipped, anything but ACGT (in either case) reads as A.
+    """
+    codes = numpy.zeros(256, dtype=numpy.uint32)
+    for base, code in (('G', 1), ('C', 2), ('T', 3)):
+        codes[ord(base)] = codes[ord(base.lower())] = code
+    skip = numpy.zeros(256, dtype=bool)
+    skip[ord(' ')] = skip[ord('\n')] = True
+    return codes, skip
+
+
+def _read_text_index(path):
+    f = open(path)
+    try:
+        lines = f.read().splitlines()
+    finally:
+        f.close()
+    n = int(lines[0])
+    return numpy.array([[int(v) for v in line.split(',')[0:5]]
+                        for line in lines[1:n+1]],
+                       dtype=numpy.uint32).reshape(-1, 5)
+
+
+def _read_binary_index(path):
+    f = open(path, 'rb')
+    try:
+        header = f.read(struct.calcsize(HEADER))
+        (magic, version, ktup, n, nkmers, nmasked, reserved) = \
+            struct.unpack(HEADER, header)
+        if ktup != KTUP:
+            raise IOError('Feature index %s is for k-mers of %d' % (path, ktup))
+        records = numpy.fromfile(f, dtype='<u4', count=5*n)
+    finally:
+        f.close()
+    return records.astype(numpy.uint32).reshape(-1, 5)
+
+
+class Scanner(object):
+    """ A feature database loaded for scanning with NumPy. """
+
+    def __init__(self, db_name, path = None):
+        self.db_name = db_name
+        if path is None:
+            path = index_path(db_name)
+        f = open(path, 'rb')
+        try:
+            magic = f.read(len(INDEX_MAGIC))
+        finally:
+            f.close()
+        if magic == INDEX_MAGIC:
+            records = _read_binary_index(path)
+        else:
+            records = _read_text_index(path)
+
+        (self.feature_index, self.fragment_index, mask, seq, self.shift) = \
+            [records[:, i].copy() for i in range(5)]
+
+        # Unmasked records come first, sorted by seq
+        masked = numpy.flatnonzero(mask)
+        self.nkmers = masked[0] if len(masked) else len(records)
+        self.kmers = seq[:self.nkmers]
+
+        # Masked records, grouped by mask and sorted by seq, then index
+        self.groups = []
+        for m in numpy.unique(mask[self.nkmers:]):
+            idx = self.nkmers + numpy.flatnonzero(mask[self.nkmers:] == m)
+            idx = idx[numpy.lexsort((idx, seq[idx]))]
+            self.groups.append((m, seq[idx], idx))
+
+        self.overhang = KTUP
+        if len(records):
+            self.overhang = max(KTUP,
+                                int(self.fragment_index.max()+2)*KTUP)
+        (self.codes, self.skip) = _base_codes()
+
+    def scan(self, sequence, threads = 1):
+        """
+        Scans the sequence, returns the frags as an array('I') of (feature
+        index, fragment index, start position, shift) records, in the same
+        order the frags program prints them. threads is ignored; it is
+        accepted so this can stand in for scanner.Scanner.
+        """
+        if isinstance(sequence, unicode):
+            sequence = sequence.encode('ascii')
+        raw = numpy.frombuffer(sequence, dtype=numpy.uint8)
+        bases = self.codes[raw[~self.skip[raw]]]
+
+        # Plasmids are circular: scan the first bases again after the
+        # last one, as scan_finish does
+        bases = numpy.concatenate((bases, bases[:self.overhang]))
+        npos = len(bases)-KTUP+1
+        if npos <= 0:
+            return array.array('I')
+
+        kmers = numpy.zeros(npos, dtype=numpy.uint32)
+        for i in range(KTUP):
+            kmers <<= 2
+            kmers |= bases[i:i+npos]
+
+        positions = []
+        records = []
+
+        lo = numpy.searchsorted(self.kmers, kmers, 'left')
+        hi = numpy.searchsorted(self.kmers, kmers, 'right')
+        (p, r) = self.__expand(lo, hi)
+        positions.append(p)
+        records.append(r)
+
+        for (mask, keys, idx) in self.groups:
+            masked = kmers & mask
+            lo = numpy.searchsorted(keys, masked, 'left')
+            hi = numpy.searchsorted(keys, masked, 'right')
+            (p, r) = self.__expand(lo, hi)
+            positions.append(p)
+            records.append(idx[r])
+
+        positions = numpy.concatenate(positions)
+        records = numpy.concatenate(records)
+
+        # frags.c reports the hits at each position in record order:
+        # unmasked records (all before the masked ones) by seq, then the
+        # masked records
+        order = numpy.lexsort((records, positions))
+        records = records[order]
+        frags = numpy.empty((len(records), 4), dtype=numpy.uint32)
+        frags[:, 0] = self.feature_index[records]
+        frags[:, 1] = self.fragment_index[records]
+        frags[:, 2] = positions[order]+1
+        frags[:, 3] = self.shift[records]
+        res = array.array('I')
+        res.fromstring(frags.tostring())
+        return res
+
+    def __expand(self, lo, hi):
+        """
+        Given the range of matching sorted keys at each position, returns
+        the (position, key) pair of every match.
+        """
+        counts = hi-lo
+        hit = numpy.flatnonzero(counts)
+        counts = counts[hit]
+        positions = numpy.repeat(hit, counts)
+        first = numpy.repeat(lo[hit], counts)
+        offsets = numpy.arange(len(positions)) - \
+            numpy.repeat(numpy.cumsum(counts)-counts, counts)
+        return positions, first+offsets
+
+
+_scanners = {}
+_scanners_lock = threading.Lock()
+
+def get_scanner(db_name):
+    """
+    Returns the process-wide NumPy scanner for the feature database,
+    loading it again once its index is rebuilt, as scanner.get_scanner
+    does.
+    """
+    version = index_version(db_name)
+    try:
+        (loaded, scanner) = _scanners[db_name]
+        if loaded == version:
+            return scanner
+    except KeyError:
+        pass
+    with _scanners_lock:
+        if db_name not in _scanners or _scanners[db_name][0] != version:
+            _scanners[db_name] = (version, Scanner(db_name, version[0]))
+        return _scanners[db_name][1]
+
+def scan(db_name, sequence):
+    return get_scanner(db_name).scan(sequence)
@@ -0,0 +1,164 @@
+"""
+In-process binding to the frags scanner.
+
+frags.c is also built as a shared library, bin/libfrags.so, which we load
+with ctypes. Each feature database is loaded once per process and kept
+around, so scanning a sequence costs neither a fork/exec, nor a temporary
+file, nor re-parsing the .data index. ctypes releases the GIL for the
+duration of the foreign call, so threads can scan concurrently. A
+database whose index is rebuilt is loaded again on its next scan.
+"""
+
+import array
+import ctypes
+import os
+import threading
+
+LIB_PATH = os.path.join(os.path.dirname(__file__), 'bin', 'libfrags.so')
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def index_path(db_name):
+    """
+    Returns the feature index to load for the database: the binary .idx
+    file made by create_frag_db.py if it is at least as new as the .data
+    file, otherwise the .data file.
+    """
+    data = os.path.join(DATA_PATH, '%s.data' % db_name)
+    idx = os.path.join(DATA_PATH, '%s.idx' % db_name)
+    try:
+        if os.path.getmtime(idx) >= os.path.getmtime(data):
+            return idx
+    except OSError:
+        if os.path.exists(idx) and not os.path.exists(data):
+            return idx
+    return data
+
+
+def index_version(db_name):
+    """
+    Returns the feature index to load for the database, with what changes
+    when create_frag_db.py rebuilds it: its size, modification time and
+    inode, as it is renamed into place.
+    """
+    path = index_path(db_name)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (path,)
+    return (path, st.st_size, st.st_mtime, st.st_ino)
+
+
+class _Feature(ctypes.Structure):
+    """ Mirrors struct feature in frags.c. """
+    _fields_ = [
+        ('feature_index', ctypes.c_uint),
+        ('fragment_index', ctypes.c_uint),
+        ('position', ctypes.c_uint),
+        ('shift', ctypes.c_uint),
+    ]
+
+
+_lib = None
+_lib_lock = threading.Lock()
+
+def _load_library():
+    global _lib
+    with _lib_lock:
+        if _lib is None:
+            lib = ctypes.CDLL(LIB_PATH)
+            lib.frags_load.argtypes = [ctypes.c_char_p]
+            lib.frags_load.restype = ctypes.c_void_p
+            lib.frags_free.argtypes = [ctypes.c_void_p]
+            lib.frags_free.restype = None
+            lib.frags_scan.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                       ctypes.c_uint,
+                                       ctypes.POINTER(ctypes.POINTER(_Feature))]
+            lib.frags_scan.restype = ctypes.c_int
+            lib.frags_scan_threads.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                               ctypes.c_uint, ctypes.c_int,
+                                               ctypes.POINTER(ctypes.POINTER(_Feature))]
+            lib.frags_scan_threads.restype = ctypes.c_int
+            lib.frags_free_hits.argtypes = [ctypes.POINTER(_Feature)]
+            lib.frags_free_hits.restype = None
+            _lib = lib
+    return _lib
+
+
+def available():
+    """ Returns True if the scanner library has been built. """
+    if _lib is not None:
+        return True
+    try:
+        _load_library()
+    except OSError:
+        return False
+    return True
+
+
+class Scanner(object):
+    """ A feature database loaded into the scanner. """
+
+    def __init__(self, db_name, path = None):
+        self.__lib = _load_library()
+        self.db_name = db_name
+        if path is None:
+            path = index_path(db_name)
+        self.__db = self.__lib.frags_load(path)
+        if not self.__db:
+            raise IOError('Cannot load feature index %s' % path)
+
+    def scan(self, sequence, threads = 1):
+        """
+        Scans the sequence, returns the frags as an array('I') of (feature
+        index, fragment index, start position, shift) records, four
+        integers per frag, in the same order the frags program prints them.
+
+        Long sequences are split over up to the given number of threads;
+        the result is the same either way.
+        """
+        if isinstance(sequence, unicode):
+            sequence = sequence.encode('ascii')
+        out = ctypes.POINTER(_Feature)()
+        n = self.__lib.frags_scan_threads(self.__db, sequence, len(sequence),
+                                          threads, ctypes.byref(out))
+        if n < 0:
+            raise MemoryError('frags scanner ran out of memory')
+        try:
+            frags = array.array('I')
+            frags.fromstring(ctypes.string_at(out, n*ctypes.sizeof(_Feature)))
+            return frags
+        finally:
+            self.__lib.frags_free_hits(out)
+
+    def __del__(self):
+        try:
+            self.__lib.frags_free(self.__db)
+        except AttributeError:
+            pass
+
+
+_scanners = {}
+_scanners_lock = threading.Lock()
+
+def get_scanner(db_name):
+    """
+    Returns the process-wide scanner for the feature database, loading it
+    again once its index is rebuilt. The old index is freed when the
+    last scan still using it is done.
+    """
+    version = index_version(db_name)
+    try:
+        (loaded, scanner) = _scanners[db_name]
+        if loaded == version:
+            return scanner
+    except KeyError:
+        pass
+    with _scanners_lock:
+        if db_name not in _scanners or _scanners[db_name][0] != version:
+            _scanners[db_name] = (version, Scanner(db_name, version[0]))
+        return _scanners[db_name][1]
+
+def scan(db_name, sequence, threads = 1):
+    return get_scanner(db_name).scan(sequence, threads)
+
@@ -0,0 +1,148 @@
+"""
+Annotates sequences in the background.
+
+queue() saves a sequence and an Annotation_Job row for it, and returns
+without annotating it. Workers take the pending jobs from the table,
+oldest first, annotate their sequences and mark the jobs done or failed.
+
+Each web process starts settings.ANNOTATION_JOB_WORKERS worker threads
+the first time it queues a job, and wakes them whenever it queues one.
+With 0, or to add workers elsewhere, run "manage.py annotation_worker";
+those workers find new jobs by reading the table every POLL_INTERVAL
+seconds.
+
+A worker holds a running job for settings.ANNOTATION_JOB_LEASE seconds
+after it started it. A job still running after that, as when its
+process stopped while running it, is taken to be lost and is pending
+again, for any worker to run; should its first worker finish it after
+all, that worker leaves the job as the later run makes it.
+"""
+
+import datetime
+import sys
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.db.models import Q
+
+from giraffe.blat.annotate import annotate
+from giraffe.blat.catalog import get_database
+from giraffe.blat.models import Annotation_Job
+from giraffe.blat.models import Sequence
+
+
+WORKERS = 1 # Worker threads in each web process
+POLL_INTERVAL = 5 # Seconds between reads of the table by an idle worker
+LEASE = 1800 # Seconds a job may run for before it is taken to be lost
+
+
+@transaction.commit_on_success
+def _save_job(sequence,db_name):
+    db = get_database(db_name)
+    s = Sequence()
+    s.sequence = Sequence.clean_sequence(sequence)
+    s.db = db
+    s.save()
+
+    now = datetime.datetime.now()
+    (job,created) = Annotation_Job.objects.get_or_create(
+        sequence=s, defaults={ 'status' : Annotation_Job.PENDING,
+                               'queued' : now })
+    if not created:
+        # A job already pending or running will annotate the sequence
+        Annotation_Job.objects.filter(
+            id=job.id,
+            status__in=(Annotation_Job.DONE,Annotation_Job.FAILED)
+        ).update(status=Annotation_Job.PENDING,error='',queued=now,
+                 started=None,finished=None)
+    return s.hash
+
+def queue(sequence,db_name):
+    """
+    Queues the sequence to be annotated with the database; returns its
+    hash. The job is committed by the time this returns.
+    """
+    hash = _save_job(sequence,db_name)
+    _start_workers()
+    _queued.set()
+    return hash
+
+
+def _run(job,started):
+    """
+    Annotates the job's sequence, then marks the job done or failed,
+    unless the job was taken again after the lease it was started with
+    ran out.
+    """
+    try:
+        s = Sequence.objects.select_related('db').get(id=job.sequence_id)
+        annotate(s.db,s)
+    except Exception as e:
+        (status,error) = (Annotation_Job.FAILED,'%s: %s' % (type(e).__name__,e))
+    else:
+        (status,error) = (Annotation_Job.DONE,'')
+    Annotation_Job.objects.filter(
+        id=job.id,status=Annotation_Job.RUNNING,started=started
+    ).update(status=status,error=error,finished=datetime.datetime.now())
+
+def _reclaim_lost():
+    """ Puts the jobs running for longer than the lease back to pending. """
+    lease = getattr(settings,'ANNOTATION_JOB_LEASE',LEASE)
+    expired = datetime.datetime.now() - datetime.timedelta(seconds=lease)
+    Annotation_Job.objects.filter(
+        Q(started__lt=expired) | Q(started__isnull=True),
+        status=Annotation_Job.RUNNING
+    ).update(status=Annotation_Job.PENDING,started=None)
+
+def run_next():
+    """
+    Runs the oldest pending job that no other worker takes first;
+    returns False if there was none.
+    """
+    _reclaim_lost()
+    pending = Annotation_Job.objects.filter(
+        status=Annotation_Job.PENDING).order_by('queued','id')
+    for job in pending[:10]:
+        # In whole seconds, as some databases keep no more, so that _run
+        # finds the job by it
+        started = datetime.datetime.now().replace(microsecond=0)
+        taken = Annotation_Job.objects.filter(
+            id=job.id,status=Annotation_Job.PENDING
+        ).update(status=Annotation_Job.RUNNING,started=started)
+        if taken:
+            _run(job,started)
+            return True
+    return False
+
+def work():
+    """ Runs jobs as they are queued, for ever. """
+    while True:
+        _queued.clear()
+        try:
+            while run_next():
+                pass
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            # Ends the connection's transaction, so the next read sees
+            # newly queued jobs
+            connection.close()
+        _queued.wait(POLL_INTERVAL)
+
+
+_queued = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+def _start_workers():
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(getattr(settings,'ANNOTATION_JOB_WORKERS',WORKERS)):
+            t = threading.Thread(target=work,name='annotation-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            _workers.append(t)
@@ -0,0 +1,8 @@
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = "Annotates the sequences queued by POST /blat/ with 'async', as they are queued, until killed."
+
+    def handle_noargs(self, **options):
+        from giraffe.blat import jobs
+        jobs.work()
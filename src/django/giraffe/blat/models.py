@@ -1,4 +1,6 @@
+from django.db import connection
 from django.db import models
+from django.db import transaction
 from django.db import utils
 import datetime
 import hashlib
@@ -12,6 +14,36 @@ class BadSequenceError(Exception):
         return repr(self.why)
 
 
+# Rows per INSERT statement when storing annotations
+INSERT_BATCH_SIZE = 500
+# Sequences annotated, and stored, at once by detect_features_many
+ANNOTATE_BATCH_SIZE = 100
+
+def _insert_all(objects,batch_size=INSERT_BATCH_SIZE):
+    """
+    Inserts unsaved model objects, all of the same model, with multi-row
+    INSERT statements. The objects are not given their ids.
+    """
+    if not objects:
+        return
+    meta = objects[0]._meta
+    fields = [f for f in meta.local_fields if f is not meta.pk]
+    qn = connection.ops.quote_name
+    row = '(%s)' % ', '.join(['%s'] * len(fields))
+    sql = 'INSERT INTO %s (%s) VALUES ' % (
+        qn(meta.db_table), ', '.join([qn(f.column) for f in fields]))
+
+    cursor = connection.cursor()
+    for i in range(0,len(objects),batch_size):
+        batch = objects[i:i+batch_size]
+        params = []
+        for obj in batch:
+            params.extend([f.get_db_prep_save(getattr(obj,f.attname),
+                                              connection=connection)
+                           for f in fields])
+        cursor.execute(sql + ', '.join([row] * len(batch)),params)
+
+
 class Giraffe_Mappable_Model(models.Model):
     """
     This is an abstract class for other apps to use with their models;
@@ -36,9 +68,9 @@ class Giraffe_Mappable_Model(models.Model):
 
     @staticmethod
     def detect_features(sequence,db_name):
-        import frags.features
-        import orfs
-        db = Feature_Database.objects.get(name=db_name)
+        from annotate import annotate
+        from catalog import get_database
+        db = get_database(db_name)
 
         # clean sequence, remove FASTA stuff, junks
         sequence = Sequence.clean_sequence(sequence)
@@ -49,17 +81,50 @@ class Giraffe_Mappable_Model(models.Model):
         s.db = db
         s.save()
 
-        # run blat algorithm to automatically detect features
-        s.clear_features()
-        frags.features.blat(db,s)
+        # run blat algorithm to automatically detect features, detect
+        # ORFs, at the same time, and store them all at once
+        annotate(db,s)
 
-        # detect ORFs
-        s.clear_orf_features()
-        orfs.detect_orfs(s)
+        # annotated now, whatever a job queued with 'async' said
+        Annotation_Job.objects.filter(sequence=s).delete()
 
         return s.hash
 
 
+    @staticmethod
+    def detect_features_many(sequences,db_name):
+        """
+        Annotates each of the sequences, as detect_features does, and
+        returns their hashes, in order. The sequences are annotated
+        ANNOTATE_BATCH_SIZE at a time, and each batch's annotations are
+        stored at once. Raises BadSequenceError before storing anything
+        if any sequence is not DNA.
+        """
+        from annotate import annotate_many
+        from catalog import get_database
+        db = get_database(db_name)
+
+        sequences = [Sequence.clean_sequence(s) for s in sequences]
+        for (i,sequence) in enumerate(sequences):
+            if not Sequence.verify_bp(sequence):
+                raise BadSequenceError(
+                    "Found non-DNA base pair character in sequence %d" % (i+1))
+
+        hashes = []
+        for b in range(0,len(sequences),ANNOTATE_BATCH_SIZE):
+            batch = []
+            for sequence in sequences[b:b+ANNOTATE_BATCH_SIZE]:
+                s = Sequence()
+                s.sequence = sequence
+                s.db = db
+                s.save()
+                batch.append(s)
+            annotate_many(db,batch)
+            Annotation_Job.objects.filter(sequence__in=batch).delete()
+            hashes.extend([s.hash for s in batch])
+        return hashes
+
+
     def giraffe_ready(self,db_name='default',force=False,save=True):
         if not self.sequence:
             self.sequence_giraffe_id = ''
@@ -178,6 +243,14 @@ class Sequence(models.Model):
         sequence = re.sub(r'[^A-Za-z*-]', '', sequence)
         return sequence
 
+    @staticmethod
+    def split_fasta(text):
+        """
+        Splits FASTA text into its records, each starting with its >
+        comment line, for clean_sequence to clean.
+        """
+        return [r for r in re.split(r'\n(?=\s*>)',text) if r.strip()]
+
     @staticmethod
     def verify_bp(sequence):
         if re.match(r'^([atgcATGCnNbdhkmnrsvwyBDHKMNRSVWYuU\s*-])*$',sequence):
@@ -264,6 +337,103 @@ class Sequence(models.Model):
         ).delete()
     clear_orf_features.alters_data = True 
 
+    def replace_annotations(self,features=None,orfs=None):
+        """
+        Replaces the sequence's features found by blat with features, a
+        list of unsaved Sequence_Features, and its ORFs and the protein
+        tags found in them with orfs, a list of (ORF, list of tags) pairs
+        of unsaved Sequence_Feature_Annotated. Either set is left alone
+        if None.
+
+        All in one transaction, with a few multi-row statements.
+        """
+        Sequence.replace_many_annotations([
+            (self, { 'features' : features, 'orfs' : orfs })
+        ])
+    replace_annotations.alters_data = True
+
+    @staticmethod
+    @transaction.commit_on_success
+    def replace_many_annotations(annotations):
+        """
+        Replaces the annotations of many sequences at once; annotations
+        is a list of (sequence, dict of the replace_annotations
+        arguments) pairs. Of a sequence listed more than once, the last
+        annotations are kept.
+
+        All in one transaction, with a few multi-row statements for
+        every INSERT_BATCH_SIZE sequences.
+        """
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+
+        by_id = {}
+        for (s,kwargs) in annotations:
+            by_id[s.id] = kwargs
+        features = [(i,kw['features']) for (i,kw) in sorted(by_id.items())
+                    if kw.get('features') is not None]
+        orfs = [(i,kw['orfs']) for (i,kw) in sorted(by_id.items())
+                if kw.get('orfs') is not None]
+
+        # Sequence.modified tells response_cache.py that the annotations
+        # changed
+        now = datetime.datetime.now()
+        ids = sorted(by_id)
+        for b in range(0,len(ids),INSERT_BATCH_SIZE):
+            Sequence.objects.filter(
+                id__in=ids[b:b+INSERT_BATCH_SIZE]).update(modified=now)
+
+        def where_in(ids,*conditions):
+            return ' AND '.join(['%s IN (%s)' % (
+                qn('sequence_id'), ', '.join(['%s'] * len(ids)))] +
+                list(conditions))
+
+        for b in range(0,len(features),INSERT_BATCH_SIZE):
+            batch = features[b:b+INSERT_BATCH_SIZE]
+            ids = [i for (i,found) in batch]
+            cursor.execute('DELETE FROM %s WHERE %s' % (
+                qn(Sequence_Feature._meta.db_table), where_in(ids)), ids)
+            all_features = []
+            for (i,found) in batch:
+                for f in found:
+                    f.sequence_id = i
+                all_features.extend(found)
+            _insert_all(all_features)
+
+        table = qn(Sequence_Feature_Annotated._meta.db_table)
+        for b in range(0,len(orfs),INSERT_BATCH_SIZE):
+            batch = orfs[b:b+INSERT_BATCH_SIZE]
+            ids = [i for (i,found) in batch]
+            # Tags refer to their ORFs, so go first
+            cursor.execute('DELETE FROM %s WHERE %s' % (table, where_in(
+                ids, '%s IS NOT NULL' % qn('orf_annotated_id'))), ids)
+            cursor.execute('DELETE FROM %s WHERE %s' % (table, where_in(
+                ids, '%s = %%s' % qn('feature_type_id'))),
+                ids + [Feature_Type.ORF])
+
+            all_orfs = []
+            for (i,found) in batch:
+                for (orf,tags) in found:
+                    orf.sequence_id = i
+                all_orfs.extend(found)
+            _insert_all([orf for (orf,tags) in all_orfs])
+
+            # The ORFs are the sequences' only ORF rows now, and get
+            # increasing ids in the order they were inserted
+            orf_ids = Sequence_Feature_Annotated.objects.filter(
+                sequence__in=ids, feature_type=Feature_Type.ORF
+            ).order_by('id').values_list('id',flat=True)
+            all_tags = []
+            for ((orf,tags),orf_id) in zip(all_orfs,orf_ids):
+                orf.id = orf_id
+                for tag in tags:
+                    tag.sequence_id = orf.sequence_id
+                    tag.orf_annotated_id = orf_id
+                all_tags.extend(tags)
+            _insert_all(all_tags)
+
+        transaction.set_dirty()
+
 
 class Feature_Type(models.Model):
     type = models.CharField(max_length=64)
@@ -341,3 +511,30 @@ class Sequence_Feature_Annotated(Sequence_Feature_Base):
             d['orf_frame'] = self.orf_frame
         return d
 
+
+class Annotation_Job(models.Model):
+    """
+    A sequence queued to be annotated in the background (see jobs.py),
+    kept with how that went.
+    """
+    sequence = models.ForeignKey(Sequence,unique=True)
+    status = models.PositiveIntegerField(db_index=True)
+    error = models.TextField(blank=True)
+    queued = models.DateTimeField()
+    started = models.DateTimeField(null=True,blank=True)
+    finished = models.DateTimeField(null=True,blank=True)
+
+    # Status constants
+    (PENDING, RUNNING, DONE, FAILED) = range(1, 5)
+    STATUS_NAMES = {
+        PENDING : 'pending',
+        RUNNING : 'running',
+        DONE : 'done',
+        FAILED : 'failed',
+    }
+
+    def to_dict(self):
+        d = { "status" : Annotation_Job.STATUS_NAMES[self.status] }
+        if self.status == Annotation_Job.FAILED:
+            d["error"] = self.error
+        return d
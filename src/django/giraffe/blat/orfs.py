@@ -1,67 +1,95 @@
 
 import models
 from Bio.Seq import Seq
+import bisect
 import math
+import re
+import string
 import tags
 
 trans_table = 1 # standard translation table
 min_protein_len = 150
 
 def detect_orfs(sequence_object):
-    sequence_object.clear_orf_features()
+    """ Replaces the sequence's ORFs, and the protein tags in them. """
+    sequence_object.replace_annotations(orfs=find_orfs(sequence_object))
+
+# Codons, on the DNA, that the standard table translates to stops, and
+# to M
+stop_codons = re.compile(r'(?=TAA|TAG|TGA)')
+start_codons = re.compile(r'(?=ATG)')
+complement = string.maketrans('ACGT','TGCA')
+
+def _codon_indexes(pattern,nuc):
+    """
+    Finds the codons the pattern matches in nuc, and returns their
+    indexes in the translation of each frame, as three sorted lists.
+    """
+    frames = ([],[],[])
+    for m in pattern.finditer(nuc):
+        frames[m.start() % 3].append(m.start() // 3)
+    return frames
+
+def find_orfs(sequence_object):
+    """
+    Returns the ORFs found in the sequence, as (ORF, list of protein
+    tags found in it) pairs of unsaved Sequence_Feature_Annotated.
+
+    Stop and start codons are found directly on the DNA, in all three
+    frames at once; only the ORFs long enough are translated, to look
+    for protein tags in them.
+    """
+    orfs = []
 
     # convert to DNA sequence, to get rid of degenerates and 'U's...
-    dna = models.Sequence.convert_to_dna(sequence_object.sequence)
+    dna = str(models.Sequence.convert_to_dna(sequence_object.sequence).upper())
 
     # double up sequence, so we can detect features across 0 bp
-    # boundary
-    seq = Seq(dna*2)
+    # boundary: an ORF is never longer than the sequence, so it can only
+    # run once across it
     seq_len = len(sequence_object.sequence)
     aa_len = int(math.floor(seq_len/3.0))
+    reverse = dna.translate(complement)[::-1]
 
-    for strand,nuc in [(+1,seq), (-1,seq.reverse_complement())]:
-        for frame in range(3):
-            #print 'strand '+str(strand)+' frame '+str(frame)
+    for strand,nuc in [(+1,dna*2), (-1,reverse*2)]:
+        stops = _codon_indexes(stop_codons,nuc)
+        starts = _codon_indexes(start_codons,nuc)
 
-            trans = str(nuc[frame:].translate(trans_table))
-            trans_len = len(trans)
+        for frame in range(3):
+            frame_stops = stops[frame]
+            frame_starts = starts[frame]
             aa_start = 0
             aa_end = 0
 
-            #print trans
-            #print 'trans_len is '+str(trans_len)
-
             # go through the translation and find end codons that
             # follow a start codon.
-            while aa_start < trans_len and aa_start < aa_len:
-                aa_end = trans.find("*", aa_start)
-                #print 'search for * from '+str(aa_start)+' found '+str(aa_end)
+            while aa_start < aa_len:
+                i = bisect.bisect_left(frame_stops,aa_start)
                 has_stop = 1
-                if aa_end == -1:
-                    #print 'no more, abort'
+                if i == len(frame_stops):
                     # no more stop codon, just abort...
                     break
+                aa_end = frame_stops[i]
 
                 # we start looking for a M at the earliest at aa_end-aa_len+1,
                 # since we don't want an ORF that's actually bigger than the
                 # original sequence
                 if aa_start < aa_end-aa_len+1:
                     aa_start = aa_end-aa_len+1
-                start_codon = trans.find('M', aa_start, aa_end)
-                #print 'found start at '+str(start_codon)
+                i = bisect.bisect_left(frame_starts,aa_start)
+                if i < len(frame_starts) and frame_starts[i] < aa_end:
+                    start_codon = frame_starts[i]
+                else:
+                    start_codon = -1
 
                 # is there a start codon? and is it before end of sequence
                 # (remember we doubled up the sequence earlier to detect orfs
                 # crossing boundaries)
                 if start_codon == -1 or start_codon >= aa_len:
-                    #print 'aborting'
-                    assert(aa_end != -1)
                     aa_start = aa_end+1
                     continue
 
                 if aa_end-start_codon >= min_protein_len:
-                    #print 'found '+trans[start_codon:aa_end]
-
                     # the following start and end need to start with
                     # 1, not 0.
                     if strand == 1:
@@ -86,16 +114,21 @@ def detect_orfs(sequence_object):
                         f.clockwise = True
                     else:
                         f.clockwise = False
-                    f.save()
                     orf_annotated = f
-                    #print str(f.to_dict())
+                    orf_tags = []
+                    orfs.append((orf_annotated,orf_tags))
 
                     # also try to see if we can find any protein tags
                     # in this ORF
-                    for tag_pair in tags.PROTEIN_TAGS:
+                    protein = str(Seq(
+                        nuc[frame+start_codon*3:frame+aa_end*3]
+                    ).translate(trans_table))
+                    hits = tags.PROTEIN_TAG_FINDER.first_hits(protein)
+                    for (tag_pair,tag_aa_start) in zip(tags.PROTEIN_TAGS,hits):
                         tag = tag_pair[0]
                         peptide = tag_pair[1]
-                        tag_aa_start = trans.find(peptide,start_codon,aa_end)
+                        if tag_aa_start >= 0:
+                            tag_aa_start += start_codon
                         if tag_aa_start >= 0 and tag_aa_start < aa_len:
                             tag_aa_end = tag_aa_start+len(peptide)
                             if strand == 1:
@@ -113,7 +146,6 @@ def detect_orfs(sequence_object):
 
                             f = models.Sequence_Feature_Annotated()
                             f.sequence = sequence_object
-                            f.orf_annotated = orf_annotated
                             f.feature_name = tag
                             f.feature_type_id = models.Feature_Type.FEATURE
                             f.start = tag_start
@@ -122,8 +154,8 @@ def detect_orfs(sequence_object):
                                 f.clockwise = True
                             else:
                                 f.clockwise = False
-                            f.save()
-                            #print str(f.to_dict())
+                            orf_tags.append(f)
 
                 aa_start = aa_end+1
 
+    return orfs
@@ -0,0 +1,76 @@
+"""
+Cache of the JSON the 'get' view returns.
+
+The entries are kept in the Django cache backend that
+settings.BLAT_CACHE_BACKEND names, as in CACHE_BACKEND: 'locmem://' for
+each process's memory, 'file:///var/tmp/giraffe' or
+'memcached://127.0.0.1:11211/' to share them between processes, with
+max_entries and timeout parameters. Nothing is cached if it is empty.
+
+An entry's key is made of everything its JSON depends on: the sequence's
+hash, its database and db_version, the 'sc' and 'sequence' options, and
+when the sequence was last annotated (Sequence.modified, which
+Sequence.replace_many_annotations sets). Re-blatting a sequence, or
+rebuilding its database, thus changes the keys it is looked up with, and
+its old entries are left to expire. As some databases keep
+Sequence.modified in whole seconds, a sequence annotated in the last
+SETTLE_TIME seconds is not cached yet.
+"""
+
+import datetime
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+BACKEND = 'locmem://?max_entries=1000'
+SETTLE_TIME = 2 # Seconds after annotating before a sequence is cached
+
+
+def key(sequence,sc,with_sequence):
+    """ Returns the cache key of the sequence's JSON. """
+    parts = (sequence.hash,sequence.db_id,sequence.db_version,
+             sequence.modified.isoformat(),bool(sc),bool(with_sequence))
+    return 'giraffe.blat.get:'+hashlib.sha1(repr(parts)).hexdigest()
+
+def settled(sequence):
+    """
+    Returns whether the sequence was annotated long enough ago for its
+    key to change if it is annotated again.
+    """
+    # Annotating again within the second might not change
+    # Sequence.modified
+    return datetime.datetime.now() >= \
+        sequence.modified + datetime.timedelta(seconds=SETTLE_TIME)
+
+
+_cache = None
+_backend = None
+_lock = threading.Lock()
+
+def _get_cache():
+    global _cache, _backend
+    backend = getattr(settings,'BLAT_CACHE_BACKEND',BACKEND)
+    with _lock:
+        if backend != _backend:
+            _cache = get_cache(backend) if backend else None
+            _backend = backend
+        return _cache
+
+def get_json(sequence,sc,with_sequence,build):
+    """
+    Returns the sequence's JSON from the cache, or else what build()
+    returns, which is then cached.
+    """
+    cache = _get_cache()
+    if cache is None:
+        return build()
+    k = key(sequence,sc,with_sequence)
+    j = cache.get(k)
+    if j is None:
+        j = build()
+        if settled(sequence):
+            cache.set(k,j)
+    return j
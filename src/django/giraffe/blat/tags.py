@@ -1,5 +1,7 @@
 # List of common protein tags
 
+import re
+
 PROTEIN_TAGS = (
     ("FLAG","DYKDDDDK"),
     ("FLAG","DYKDHDI"),
@@ -38,3 +40,59 @@ PROTEIN_TAGS = (
     ("I197 (mTangerine)",           "YKTDIKLDI"),
 )
 
+
+
+def _trie_pattern(node):
+    """
+    Returns a regular expression matching the start of any of the
+    peptides in the trie below the node, branching on one amino acid at
+    a time.
+    """
+    if None in node:
+        return ''
+    alternatives = [re.escape(aa)+_trie_pattern(child)
+                    for (aa,child) in sorted(node.items())]
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return '(?:%s)' % '|'.join(alternatives)
+
+class TagFinder(object):
+    """
+    Finds all of a list of (name, peptide) tags in a protein in one scan,
+    however many tags there are: the peptides are kept in a trie, and a
+    regular expression built from the trie finds where any of them
+    starts.
+    """
+
+    def __init__(self,tags):
+        self.tags = tuple(tags)
+        self.__trie = {}
+        for (i,(name,peptide)) in enumerate(self.tags):
+            node = self.__trie
+            for aa in peptide:
+                node = node.setdefault(aa,{})
+            node.setdefault(None,[]).append(i)
+        self.__starts = re.compile('(?=%s)' % _trie_pattern(self.__trie))
+
+    def first_hits(self,protein):
+        """
+        Returns, for each tag, in order, the index of the first place
+        its peptide occurs in the protein, or -1 if it does not.
+        """
+        hits = [-1]*len(self.tags)
+        missing = len(self.tags)
+        for m in self.__starts.finditer(protein):
+            p = q = m.start()
+            node = self.__trie
+            while node is not None:
+                for i in node.get(None,()):
+                    if hits[i] < 0:
+                        hits[i] = p
+                        missing -= 1
+                node = node.get(protein[q]) if q < len(protein) else None
+                q += 1
+            if missing == 0:
+                break
+        return hits
+
+PROTEIN_TAG_FINDER = TagFinder(PROTEIN_TAGS)
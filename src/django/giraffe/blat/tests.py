@@ -338,6 +338,905 @@ GATGACGACGACAAG""")
 
 
 
+class ItScansSequencesInProcess(unittest.TestCase):
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def test_ItFindsTheSameFragsAsTheBinary(self):
+        """Tests that the scanner library and bin/frags agree"""
+        from giraffe.blat.frags import features, scanner
+        if not scanner.available():
+            return
+
+        seqs = [
+            'GATGACGACGACAAG',
+            'gacaag' + 't' * 4096  + 'gatgacgac',
+            'A',
+            'TTTAAAGATGAC GACGAC\nAAGNNTTTAAA',
+            open('frags/data/slow_sequence.data').read(),
+        ]
+        for db_name in ('default', 'afire'):
+            for seq in seqs:
+                self.assertEqual(scanner.scan(db_name, seq),
+                    features._get_frags_from_binary(db_name, seq))
+
+    def test_ItReadsTextAndBinaryIndexesAlike(self):
+        """Tests that the .idx index finds the same frags as the .data one"""
+        import os
+        from giraffe.blat.frags import scanner
+        if not scanner.available():
+            return
+
+        seq = open('frags/data/slow_sequence.data').read()
+        for db_name in ('default', 'afire'):
+            idx = 'frags/data/%s.idx' % db_name
+            if not os.path.exists(idx):
+                continue
+            text = scanner.Scanner(db_name, 'frags/data/%s.data' % db_name)
+            binary = scanner.Scanner(db_name, idx)
+            self.assertEqual(text.scan(seq), binary.scan(seq))
+
+    def test_ItScansLongSequences(self):
+        """Tests that features past the old 600 kb limit are found"""
+        from giraffe.blat.frags import scanner
+        if not scanner.available():
+            return
+
+        ek = 'GATGACGACGACAAG'
+        frags = scanner.scan('default', 'T' * 700000 + ek)
+        self.assertTrue(700001 in frags[2::4])
+
+    def test_ItFindsTheSameFragsWithThreads(self):
+        from giraffe.blat.frags import scanner
+        if not scanner.available():
+            return
+
+        import random
+        r = random.Random(7)
+        ek = 'GATGACGACGACAAG'
+        # Plant a feature on each side of every chunk boundary, and one
+        # spanning the end of the circular sequence
+        seq = ''.join(r.choice('ACGT') for i in range(400000))
+        for i in range(65536, len(seq), 65536):
+            seq = seq[:i-10] + ek + seq[i+5:]
+        seq = ek[7:] + seq[len(ek)-7:-7] + ek[:7]
+        serial = scanner.scan('default', seq)
+        for threads in (2, 4, 7):
+            self.assertEquals(scanner.scan('default', seq, threads), serial)
+
+    def test_ItLoadsEachDatabaseOnce(self):
+        from giraffe.blat.frags import scanner
+        if not scanner.available():
+            return
+        self.assertTrue(scanner.get_scanner('default') is
+                        scanner.get_scanner('default'))
+
+    def test_ItReloadsARebuiltIndex(self):
+        import os
+        from giraffe.blat.frags import scanner
+        if not scanner.available():
+            return
+        loaded = scanner.get_scanner('default')
+        path = scanner.index_path('default')
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        try:
+            reloaded = scanner.get_scanner('default')
+            self.assertFalse(reloaded is loaded)
+            self.assertTrue(scanner.get_scanner('default') is reloaded)
+            self.assertEqual(reloaded.scan('GATGACGACGACAAG'),
+                             loaded.scan('GATGACGACGACAAG'))
+        finally:
+            os.utime(path, (st.st_atime, st.st_mtime))
+
+
+class ItScansSequencesOnTheServer(unittest.TestCase):
+
+    def setUp(self):
+        import os, subprocess, tempfile, time
+        self.path = tempfile.mktemp(suffix='.sock')
+        self.server = subprocess.Popen(['frags/bin/frags', '-s', self.path,
+            '-w', '2', 'frags/data/default.data', 'frags/data/afire.data'])
+        for i in range(100):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        import os
+        self.server.terminate()
+        self.server.wait()
+        os.unlink(self.path)
+
+    def test_ItFindsTheSameFragsAsTheBinary(self):
+        from giraffe.blat.frags import client, features
+        pool = client.ConnectionPool(self.path)
+
+        seqs = [
+            'GATGACGACGACAAG',
+            'gacaag' + 't' * 4096  + 'gatgacgac',
+            'A',
+            '',
+        ]
+        for db_name in ('default', 'afire'):
+            for seq in seqs:
+                self.assertEqual(pool.scan(db_name, seq),
+                    features._get_frags_from_binary(db_name, seq))
+        pool.close()
+
+    def test_ItRejectsUnknownDatabases(self):
+        from giraffe.blat.frags import client
+        pool = client.ConnectionPool(self.path)
+        self.assertRaises(client.ScanError, pool.scan, 'nosuchdb', 'GATC')
+        # the connection is still good afterwards
+        self.assertEqual(len(pool.scan('default', 'A')), 0)
+        pool.close()
+
+
+class ItStoresAnnotationsInBulk(unittest.TestCase):
+
+    # An ORF with a 6xHIS tag before its stop codon
+    sequence = "atggcagcgcgccgaccgcgatgggctgtggccaatagcggctgctcagcagggcgcgccgagagcagcggccgggaaggggcggtgcgggaggcggggtgtggggcggtagtgtgggccctgttcctgcccgcgcggtgttccgcattctgcaagcctccggagcgcacgtcggcagtcggctccctcgttgaccgaatcaccgacctctctccccagggggatccaccggagcttaccatgaccgagtacaagcccacggtgcgcctcgccacccgcgacgacgtccccagggccgtacgcaccctcgccgccgcgttcgccgactaccccgccacgcgccacaccgtcgatccggaccgccacatcgagcgggtcaccgagctgcaagaactcttcctcacgcgcgtcgggctcgacatcggcaaggtgtgggtcgcggacgacggcgccgcggtggcggtctggaccacgccggagagcgtcgaagcgggggcggtgttcgccgagatcggcccgcgcatggccgagttgagcggttcccggctggccgcgcagcaacagatggaaggcctcctggcgccgcaccggcccaaggagcccgcgtggttcctggccaccgtcggcgtctcgcccgaccaccagggcaagggtctgggcagcgccgtcgtgctccccggagtggaggcggccgagcgcgccggggtgcccgccttcctggagacctccgcgccccgcaacctccccttctacgagcggctcggcttcaccgtcaccgccgacgtcgaggtgcccgaaggaccgcgcacctggtgcatgacccgcaagcccggtgcccaccaccaccaccaccactga"
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def annotations(self, hash):
+        db = models.Feature_Database.objects.get(name='default')
+        s = models.Sequence.objects.get(db=db, hash=hash)
+        return (list(s.sequence_feature_set.order_by('id')),
+                list(s.sequence_feature_annotated_set.order_by('id')))
+
+    def test_ItLinksTagsToTheirORFs(self):
+        hash = models.Giraffe_Mappable_Model.detect_features(self.sequence,
+                                                             'default')
+        (features, annotated) = self.annotations(hash)
+        orfs = [a for a in annotated
+                if a.feature_type_id == models.Feature_Type.ORF]
+        tags = [a for a in annotated if a.orf_annotated_id is not None]
+        self.assertTrue(len(features) > 0)
+        self.assertTrue('6xHIS' in [t.feature_name for t in tags])
+        for tag in tags:
+            orf = tag.orf_annotated
+            self.assertTrue(orf in orfs)
+            self.assertEqual(orf.clockwise, tag.clockwise)
+            if orf.clockwise and orf.start < orf.end:
+                self.assertTrue(orf.start <= tag.start <= tag.end <= orf.end)
+
+    def test_ItFindsTheSameTagsOnTheOtherStrand(self):
+        import string
+        from giraffe.blat.orfs import find_orfs
+        n = len(self.sequence)
+        reverse = self.sequence.upper().translate(
+            string.maketrans('ACGT', 'TGCA'))[::-1]
+
+        found = []
+        for seq in (self.sequence, reverse):
+            s = models.Sequence(sequence=seq)
+            found.append([(orf.start, orf.end, orf.clockwise,
+                           [(t.feature_name, t.start, t.end) for t in tags])
+                          for (orf, tags) in find_orfs(s)
+                          if tags])
+
+        self.assertEqual(len(found[0]), 1)
+        (start, end, clockwise, tags) = found[0][0]
+        self.assertTrue(clockwise)
+        self.assertTrue(('6xHIS', n-20, n-3) in tags)
+        self.assertEqual(found[1], [
+            (n-end+1, n-start+1, False,
+             [(name, n-e+1, n-s+1) for (name, s, e) in tags])])
+
+    def test_ItFindsEveryTagWhereStrFindDoes(self):
+        from giraffe.blat.tags import TagFinder
+        tags = (("SV40 NLS", "PKKKRKV"), ("SV40 NLS", "PKKKRKVG"),
+                ("NLS", "KKRKV"), ("6xHIS", "HHHHHH"), ("X", "HHH"))
+        finder = TagFinder(tags)
+        for protein in ('', 'MPKKKRKVGHHHHHHHK', 'MKKRKVPKKKRKV',
+                        'MHHHHH', 'PKKKRKPKKKRKVHHHHHH'):
+            self.assertEqual(finder.first_hits(protein),
+                             [protein.find(peptide) for (name, peptide) in tags])
+
+    def test_ItReplacesAnnotationsInAFewQueries(self):
+        from django.db import connection
+        hash = models.Giraffe_Mappable_Model.detect_features(self.sequence,
+                                                             'default')
+        (features, annotated) = self.annotations(hash)
+
+        django.conf.settings.DEBUG = True
+        connection.queries = []
+        try:
+            models.Giraffe_Mappable_Model.detect_features(self.sequence,
+                                                          'default')
+            queries = len(connection.queries)
+        finally:
+            django.conf.settings.DEBUG = False
+
+        # The sequence row, and replacing the annotations
+        self.assertTrue(queries <= 12, queries)
+        (again, annotated_again) = self.annotations(hash)
+        self.assertEqual([f.to_dict() for f in again],
+                         [f.to_dict() for f in features])
+        self.assertEqual([a.to_dict() for a in annotated_again],
+                         [a.to_dict() for a in annotated])
+
+
+class ItRunsAnnotationStagesTogether(unittest.TestCase):
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def test_ItRunsTheStagesAtTheSameTime(self):
+        import threading
+        from giraffe.blat.annotate import find_annotations
+        started = threading.Event()
+
+        def waits(db, s):
+            return started.wait(5)
+        def starts(db, s):
+            started.set()
+            return threading.current_thread()
+
+        found = find_annotations(None, None, [('a', waits), ('b', starts)])
+        self.assertTrue(found['a'])
+        self.assertFalse(found['b'] is threading.current_thread())
+
+    def test_ItFindsWhatTheStagesFindOneAfterTheOther(self):
+        from giraffe.blat import catalog
+        from giraffe.blat.annotate import find_annotations
+        db = catalog.get_database('default')
+        s = models.Sequence(sequence=ItStoresAnnotationsInBulk.sequence)
+
+        def dicts(found):
+            return ([f.to_dict() for f in found['features']],
+                    [(o.to_dict(), [t.to_dict() for t in tags])
+                     for (o, tags) in found['orfs']])
+
+        together = dicts(find_annotations(db, s))
+        threads = django.conf.settings.ANNOTATION_THREADS
+        django.conf.settings.ANNOTATION_THREADS = 0
+        try:
+            self.assertEqual(dicts(find_annotations(db, s)), together)
+        finally:
+            django.conf.settings.ANNOTATION_THREADS = threads
+        self.assertTrue(together[0] and together[1])
+
+
+class ItAnnotatesQueuedSequencesInTheBackground(unittest.TestCase):
+
+    sequence = 'GATGACGACGACAAGAAACCCGGGTTTAAACCCGGGTTTGATTACA'
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+        self.workers = django.conf.settings.ANNOTATION_JOB_WORKERS
+        django.conf.settings.ANNOTATION_JOB_WORKERS = 0
+        models.Sequence.objects.filter(
+            hash=models.Sequence.clean_and_hash(self.sequence)[1]).delete()
+
+    def tearDown(self):
+        django.conf.settings.ANNOTATION_JOB_WORKERS = self.workers
+
+    def test_ItAnswersAcceptedUntilTheJobIsDone(self):
+        import json
+        from django.test.client import Client
+        from giraffe.blat import jobs
+        client = Client()
+
+        res = client.post('/blat/', { 'db' : 'default', 'async' : '1',
+                                      'sequence' : self.sequence })
+        self.assertEqual(res.status_code, 202)
+        posted = json.loads(res.content)
+        self.assertTrue(res['Location'].endswith(posted['job']))
+        url = '/blat/%s/default/' % posted['hash']
+
+        self.assertEqual(client.get(url).status_code, 202)
+        self.assertEqual(json.loads(client.get(posted['job']).content),
+                         { 'status' : 'pending' })
+
+        self.assertTrue(jobs.run_next())
+        self.assertFalse(jobs.run_next())
+        status = json.loads(client.get(posted['job']).content)
+        self.assertEqual(status['status'], 'done')
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        (length, features) = json.loads(res.content)
+        self.assertTrue('EK' in [f['feature'] for f in features])
+
+    def test_ItQueuesASequenceOnce(self):
+        from giraffe.blat import jobs
+        hash = jobs.queue(self.sequence, 'default')
+        self.assertEqual(jobs.queue(self.sequence.lower(), 'default'), hash)
+        job = models.Annotation_Job.objects.get(sequence__hash=hash)
+        self.assertEqual(job.status, models.Annotation_Job.PENDING)
+
+        self.assertTrue(jobs.run_next())
+        jobs.queue(self.sequence, 'default')
+        job = models.Annotation_Job.objects.get(sequence__hash=hash)
+        self.assertEqual(job.status, models.Annotation_Job.PENDING)
+        self.assertTrue(jobs.run_next())
+
+    def test_ItForgetsTheJobWhenPostedWithoutAsync(self):
+        from django.test.client import Client
+        from giraffe.blat import jobs
+        client = Client()
+        hash = jobs.queue(self.sequence, 'default')
+        models.Annotation_Job.objects.filter(sequence__hash=hash).update(
+            status=models.Annotation_Job.FAILED, error='Error: lost')
+        url = '/blat/%s/default/' % hash
+        self.assertEqual(client.get(url).status_code, 500)
+
+        res = client.post('/blat/', { 'db' : 'default',
+                                      'sequence' : self.sequence })
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(client.get(url).status_code, 200)
+        res = client.get('/blat/batch/default/?hashes=%s' % hash)
+        self.assertEqual(res['Cache-Control'], 'max-age=2592000')
+
+    def test_ItRunsAgainAJobLostWhileRunning(self):
+        import datetime
+        from giraffe.blat import jobs
+        hash = jobs.queue(self.sequence, 'default')
+        job = models.Annotation_Job.objects.filter(sequence__hash=hash)
+
+        # As if taken by a worker that has just started it
+        job.update(status=models.Annotation_Job.RUNNING,
+                   started=datetime.datetime.now())
+        self.assertFalse(jobs.run_next())
+        self.assertEqual(job.get().status, models.Annotation_Job.RUNNING)
+
+        # As if its process stopped while running it, long ago
+        lease = getattr(django.conf.settings, 'ANNOTATION_JOB_LEASE',
+                        jobs.LEASE)
+        job.update(started=datetime.datetime.now() -
+                   datetime.timedelta(seconds=lease + 60))
+        self.assertTrue(jobs.run_next())
+        self.assertEqual(job.get().status, models.Annotation_Job.DONE)
+
+    def test_ItLeavesAJobTakenAgainToItsLaterRun(self):
+        import datetime
+        from giraffe.blat import jobs
+        hash = jobs.queue(self.sequence, 'default')
+        job = models.Annotation_Job.objects.filter(sequence__hash=hash)
+        now = datetime.datetime.now().replace(microsecond=0)
+        lease = getattr(django.conf.settings, 'ANNOTATION_JOB_LEASE',
+                        jobs.LEASE)
+        first = now - datetime.timedelta(seconds=lease + 60)
+
+        # Taken again after the lease of its first run ran out, and still
+        # running when that first run ends
+        job.update(status=models.Annotation_Job.RUNNING, started=now)
+        jobs._run(job.get(), first)
+        self.assertEqual(job.get().status, models.Annotation_Job.RUNNING)
+        self.assertEqual(job.get().started, now)
+
+        jobs._run(job.get(), now)
+        self.assertEqual(job.get().status, models.Annotation_Job.DONE)
+
+
+class ItAnnotatesBatchesOfSequences(unittest.TestCase):
+
+    sequences = [ItStoresAnnotationsInBulk.sequence,
+                 'GATGACGACGACAAG',
+                 open('frags/data/slow_sequence.data').read()]
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def annotations(self, hash):
+        s = models.Sequence.objects.get(hash=hash, db__name='default')
+        return ([f.to_dict() for f in s.sequence_feature_set.all()],
+                sorted([a.to_dict() for a in
+                        s.sequence_feature_annotated_set.all()]))
+
+    def test_ItFindsWhatPostingEachSequenceFinds(self):
+        hashes = [models.Giraffe_Mappable_Model.detect_features(s, 'default')
+                  for s in self.sequences]
+        alone = [self.annotations(h) for h in hashes]
+
+        batch = self.sequences + self.sequences[:1]
+        self.assertEqual(models.Giraffe_Mappable_Model.detect_features_many(
+            batch, 'default'), hashes + hashes[:1])
+        self.assertEqual([self.annotations(h) for h in hashes], alone)
+
+    def test_ItTakesFASTAOrJSON(self):
+        import json
+        from django.test.client import Client
+        client = Client()
+        hashes = [models.Sequence.clean_and_hash(s)[1]
+                  for s in self.sequences]
+
+        fasta = '\n'.join(['>seq %d\n%s' % (i, s)
+                           for (i, s) in enumerate(self.sequences)])
+        for sequences in (fasta, json.dumps(self.sequences)):
+            res = client.post('/blat/batch/', { 'db' : 'default',
+                                                'sequences' : sequences })
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.content), hashes)
+
+        res = client.post('/blat/batch/', { 'db' : 'default',
+            'sequences' : '>good\nGATGACGACGACAAG\n>bad\nGATGAC1234XX' })
+        self.assertEqual(res.status_code, 400)
+
+        for sequences in ('[1, null]', '["GATGAC", ', '[{"a" : 1}]'):
+            res = client.post('/blat/batch/', { 'db' : 'default',
+                                                'sequences' : sequences })
+            self.assertEqual(res.status_code, 400)
+            self.assertTrue('error' in json.loads(res.content))
+
+
+class ItGetsTheFeaturesOfManySequencesAtOnce(unittest.TestCase):
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def test_ItGetsWhatGettingEachSequenceGets(self):
+        import json
+        from django.db import connection
+        from django.test.client import Client
+        client = Client()
+        hashes = models.Giraffe_Mappable_Model.detect_features_many(
+            ItAnnotatesBatchesOfSequences.sequences, 'default')
+        missing = '0' * 40
+
+        for args in ('', '?sc=1&sequence=1'):
+            alone = dict([(h, json.loads(client.get(
+                '/blat/%s/default/%s' % (h, args)).content)) for h in hashes])
+            alone[missing] = None
+
+            queries = []
+            for n in (1, len(hashes)):
+                url = '/blat/batch/default/?hashes=%s&hash=%s' % (
+                    ','.join(hashes[:n]), missing)
+                if args:
+                    url += '&' + args[1:]
+                django.conf.settings.DEBUG = True
+                connection.queries = []
+                try:
+                    res = client.get(url)
+                    queries.append(len(connection.queries))
+                finally:
+                    django.conf.settings.DEBUG = False
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(json.loads(res.content), dict(
+                    [(h, alone[h]) for h in hashes[:n] + [missing]]))
+                self.assertEqual(res['Cache-Control'], 'no-cache')
+            self.assertEqual(queries[0], queries[1])
+
+        res = client.get('/blat/batch/default/?hashes=%s' % ','.join(hashes))
+        self.assertEqual(res['Cache-Control'], 'max-age=2592000')
+
+
+class ItCachesTheFeaturesJSON(unittest.TestCase):
+
+    def setUp(self):
+        import datetime
+        django.conf.settings.DEBUG = False
+        self.hash = models.Giraffe_Mappable_Model.detect_features(
+            ItStoresAnnotationsInBulk.sequence, 'default')
+        # As if annotated an hour ago, so that it may be cached
+        models.Sequence.objects.filter(hash=self.hash).update(
+            modified=datetime.datetime.now() - datetime.timedelta(hours=1))
+        self.url = '/blat/%s/default/' % self.hash
+
+    def get(self, **headers):
+        from django.db import connection
+        from django.test.client import Client
+        django.conf.settings.DEBUG = True
+        connection.queries = []
+        try:
+            res = Client().get(self.url, **headers)
+            return (res, len(connection.queries))
+        finally:
+            django.conf.settings.DEBUG = False
+
+    def test_ItAnswersNotModifiedForTheSameETag(self):
+        (res, built) = self.get()
+        self.assertEqual(res.status_code, 200)
+        (cached, queries) = self.get()
+        self.assertTrue(queries < built, (queries, built))
+        self.assertEqual(cached.content, res.content)
+        self.assertEqual(cached['ETag'], res['ETag'])
+
+        # weak, as gzipped bodies have the same ETag
+        self.assertTrue(res['ETag'].startswith('W/"'))
+
+        for etag in (res['ETag'], '*'):
+            (not_modified, queries) = self.get(HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.content, '')
+            self.assertEqual(not_modified['ETag'], res['ETag'])
+        (res, queries) = self.get(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(res.status_code, 200)
+
+    def test_ItForgetsTheJSONWhenReblatted(self):
+        import json
+        (res, queries) = self.get()
+        self.assertTrue(json.loads(res.content)[1])
+
+        s = models.Sequence.objects.get(hash=self.hash, db__name='default')
+        s.replace_annotations(features=[], orfs=[])
+        (res, queries) = self.get()
+        self.assertEqual(json.loads(res.content)[1], [])
+
+
+class ItCachesTheFeatureCatalog(unittest.TestCase):
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def test_ItMakesNoCatalogQueriesAfterWarmUp(self):
+        from django.db import connection
+        from giraffe.blat import catalog
+        from giraffe.blat.frags.frags_to_features import frags_to_features
+        from giraffe.blat.frags import features
+
+        db = catalog.get_database('default')
+        frags = features._get_frags('default', 'GATGACGACGACAAG')
+        frags_to_features(frags, db, 15)
+
+        django.conf.settings.DEBUG = True
+        connection.queries = []
+        try:
+            self.assertTrue(catalog.get_database('default') is db)
+            self.assertEqual(len(frags_to_features(frags, db, 15)), 1)
+            self.assertEqual(connection.queries, [])
+        finally:
+            django.conf.settings.DEBUG = False
+
+    def test_ItReloadsWhenTheVersionChanges(self):
+        from giraffe.blat import catalog
+        db = catalog.get_database('default')
+        c = catalog.get_catalog(db)
+        self.assertTrue(catalog.get_catalog(db) is c)
+        self.assertTrue(len(c) > 0)
+
+        version = db.db_version
+        db.db_version = version + '-new'
+        try:
+            self.assertFalse(catalog.get_catalog(db) is c)
+        finally:
+            db.db_version = version
+            catalog.invalidate('default')
+
+
+class ItBuildsTrainsFromFrags(unittest.TestCase):
+
+    class FeatureData(object):
+        def __init__(self, length, type):
+            self.length = length
+            self.type = type
+            self.name = 'x'
+            self.clockwise = True
+
+    def trains(self, f, frags, feature_data, seq_length):
+        return [(str(t), t.hits, t.short, t.mutations, t.inserts, t.deletes)
+                for t in f(frags, feature_data, seq_length)]
+
+    def random_frags(self, r):
+        """Returns copies of a feature with gaps and shifted frags, the
+        feature data, and the sequence length"""
+        from giraffe.blat.frags.frags_to_features import Frag
+        T = models.Feature_Type
+        length = r.choice((30, 100, 400))
+        nfrags = (length-1)/12 + 1
+        data = self.FeatureData(length, r.choice((T.FEATURE, T.GENE,
+                                                  T.EXACT_FEATURE)))
+        frags = []
+        start = 1
+        for copy in range(r.randint(1, 5)):
+            for fragment_index in range(nfrags):
+                if r.random() < 0.25:
+                    continue
+                position = start + fragment_index*12
+                if r.random() < 0.3:
+                    position = max(1, position + r.randint(-15, 15))
+                frags.append(Frag(7, fragment_index, position, 0))
+            start += r.choice((length/2, length, 3*length, 20*length))
+        frags.sort(key=lambda f: f.seq_start_position)
+        return (frags, data, start)
+
+    def test_ItTriesOnlyTheTrainsInReachInTheSameOrder(self):
+        """Tests that the train window makes the same trains as trying
+        every train, on copies of a feature with gaps and shifted frags"""
+        import random
+        from giraffe.blat.frags.frags_to_features import \
+            _frags_to_trains_by_trying_all, _frags_to_trains_by_window
+        r = random.Random(3)
+
+        for i in range(100):
+            (frags, data, start) = self.random_frags(r)
+            self.assertEqual(
+                self.trains(_frags_to_trains_by_window, frags, data, start),
+                self.trains(_frags_to_trains_by_trying_all, frags, data, start))
+
+    def test_ItCopiesTrainsWithoutChangingTheOriginal(self):
+        """Tests that a copied train shares its frags, but extending either
+        train leaves the other alone"""
+        from copy import deepcopy
+        from giraffe.blat.frags.frags_to_features import Frag, FragTrain
+        data = self.FeatureData(100, models.Feature_Type.FEATURE)
+        train = FragTrain(data, frags=[Frag(7, 0, 1, 0), Frag(7, 1, 13, 0)])
+        copy = deepcopy(train)
+        copy.extend(Frag(7, 3, 37, 0))
+        copy.mutations += 12
+        train.extend(Frag(7, 2, 25, 0))
+
+        self.assertEqual(str(train), '[[7 0 1 0] [7 1 13 0] [7 2 25 0]]')
+        self.assertEqual(str(copy), '[[7 0 1 0] [7 1 13 0] [7 3 37 0]]')
+        self.assertEqual((len(train), train.hits, train.mutations), (3, 36, 0))
+        self.assertEqual((len(copy), copy.hits, copy.mutations), (3, 36, 12))
+        self.assertTrue(train.head is copy.head)
+        self.assertEqual(copy.tail.fragment_index, 3)
+
+    def repeat_frags(self, r):
+        """Returns copies of a feature with tandem repeats of some of
+        its frags, and frags found twice, the feature data, and the
+        sequence length"""
+        from giraffe.blat.frags.frags_to_features import Frag
+        T = models.Feature_Type
+        length = r.choice((60, 100, 200, 400))
+        nfrags = (length-1)/12 + 1
+        data = self.FeatureData(length, r.choice((T.FEATURE, T.GENE,
+                                                  T.EXACT_FEATURE)))
+        frags = []
+        position = 1
+        for copy in range(r.randint(1, 8)):
+            fragment_indexes = range(nfrags)
+            if r.random() < 0.5:
+                a = r.randint(0, nfrags-1)
+                b = r.randint(a, nfrags-1)
+                fragment_indexes[b+1:b+1] = range(a, b+1)
+            for fragment_index in fragment_indexes:
+                if r.random() > 0.2:
+                    shifted = position
+                    if r.random() < 0.3:
+                        shifted = max(1, position + r.randint(-15, 15))
+                    frags.append(Frag(7, fragment_index, shifted, 0))
+                    if r.random() < 0.1:
+                        frags.append(Frag(7, fragment_index,
+                                          shifted + r.randint(1, 30), 0))
+                position += 12
+            position += r.choice((0, 5, length/2, length, 3*length))
+        frags.sort(key=lambda f: f.seq_start_position)
+        return (frags, data, position)
+
+    def test_ItFindsWhatTheUnprunedTrainsFind(self):
+        """Tests that, with no beam, the good trains are those of linking
+        every frag to every train and dropping none, on repetitive
+        copies of a feature"""
+        import random
+        import giraffe.blat.frags.frags_to_features as f2f
+        r = random.Random(5)
+        f2f.reset_pruning_counts()
+
+        for i in range(100):
+            (frags, data, start) = self.repeat_frags(r)
+            self.assertEqual(
+                self.trains(lambda *args: f2f._pick_good_trains(
+                    f2f._frags_to_trains(*args)), frags, data, start),
+                self.trains(lambda *args: f2f._pick_good_trains(
+                    f2f._frags_to_trains_by_trying_all(*args)),
+                    frags, data, start))
+        self.assertEqual(f2f.pruning_counts()['dominated'], 0)
+
+    def test_ItDropsOnlyCopiesMadeOfTheSameFrags(self):
+        """Tests that the trains dropped as dominated are made of the
+        same frags as a train kept, which is at least as good"""
+        import random
+        import giraffe.blat.frags.frags_to_features as f2f
+        r = random.Random(5)
+        f2f.reset_pruning_counts()
+
+        for i in range(50):
+            (frags, data, start) = self.repeat_frags(r)
+            kept = f2f._frags_to_trains_by_trying_all(frags, data, start,
+                                                      True)
+            every = f2f._frags_to_trains_by_trying_all(frags, data, start)
+            for train in every:
+                self.assertTrue([t for t in kept
+                                 if t.has_same_frags(train) and
+                                    t.short == train.short and
+                                    f2f._dominates(t, train)])
+        self.assertTrue(f2f.pruning_counts()['dominated'] > 0)
+
+    def test_ItSkipsOnlyFeaturesWithNoGoodTrains(self):
+        """Tests that the frags skipped before building trains make no
+        good trains"""
+        import random
+        import giraffe.blat.frags.frags_to_features as f2f
+        r = random.Random(11)
+
+        skipped = 0
+        for i in range(200):
+            (frags, data, start) = self.random_frags(r)
+            keep = r.random()
+            frags = [f for f in frags if r.random() < keep] or frags[:1]
+            if not f2f._may_have_good_trains(frags, data):
+                skipped += 1
+                self.assertEqual(f2f._pick_good_trains(
+                    f2f._frags_to_trains(frags, data, start)), [])
+        self.assertTrue(skipped > 0)
+
+    def test_ItExtendsNoMoreTrainsThanTheBeamWidth(self):
+        """Tests that the beam bounds the trains tried for each frag, on a
+        feature made of repeats, and changes nothing until it is reached"""
+        import random
+        import giraffe.blat.frags.frags_to_features as f2f
+        data = self.FeatureData(240, models.Feature_Type.FEATURE)
+        frags = [f2f.Frag(7, fragment_index, position, 0)
+                 for position in range(1, 1500, 12)
+                 for fragment_index in range(20)
+                 if (position/12 - fragment_index) % 3 == 0]
+
+        tried = []
+        link = f2f._link_frag_to_train
+        def counting_link(frag, train, fx, trains):
+            tried.append(fx)
+            return link(frag, train, fx, trains)
+        f2f._link_frag_to_train = counting_link
+        try:
+            f2f.reset_pruning_counts()
+            f2f._frags_to_trains(frags, data, 2000, 8)
+        finally:
+            f2f._link_frag_to_train = link
+        self.assertTrue(f2f.pruning_counts()['beam'] > 0)
+        for fx in set(tried):
+            self.assertTrue(tried.count(fx) <= 8)
+
+        r = random.Random(7)
+        unreached = 0
+        for i in range(20):
+            (frags, data, start) = self.random_frags(r)
+            f2f.reset_pruning_counts()
+            bounded = self.trains(
+                lambda *args: f2f._frags_to_trains(*args + (64,)),
+                frags, data, start)
+            if f2f.pruning_counts()['beam'] == 0:
+                unreached += 1
+                self.assertEqual(bounded, self.trains(
+                    f2f._frags_to_trains, frags, data, start))
+        self.assertTrue(unreached > 0)
+
+
+class ItPrunesOverlappingTrains(unittest.TestCase):
+
+    class Train(object):
+        """A stand-in for FragTrain, with just what pruning looks at"""
+        from giraffe.blat.frags.frags_to_features import FragTrain
+        overlaps_with_in_sequence = \
+            FragTrain.overlaps_with_in_sequence.im_func
+        has_similar_name = FragTrain.has_similar_name.im_func
+
+        class Feature(object):
+            def __init__(self, type, name):
+                self.type = type
+                self.name = name
+
+        def __init__(self, left, stop, score, type, name):
+            self.left_position = left
+            self.stop_position = stop
+            self.start_position = left
+            self.score = score
+            self.feature = self.Feature(type, name)
+
+        def to_sequence_feature(self, seq_length):
+            return self
+
+    def test_ItPrunesTheSameTrainsAsCheckingThemAll(self):
+        import random
+        from giraffe.blat.frags.frags_to_features import \
+            _trains_to_features, _is_pruned
+        T = models.Feature_Type
+        r = random.Random(12)
+        types = (T.GENE, T.FEATURE, T.PROMOTER, T.ENZYME)
+        names = ('lacZ', 'lacZ alpha', 'amp', 'AmpR', 'ori', 'T7')
+
+        for i in range(50):
+            trains = []
+            for j in range(r.randint(0, 200)):
+                left = r.randint(-100, 5000)
+                stop = left + r.randint(-20, 2000)
+                trains.append(self.Train(left, stop,
+                                         r.choice((0.0, 0.1, 0.2, r.random())),
+                                         r.choice(types), r.choice(names)))
+            r.shuffle(trains)
+
+            kept = _trains_to_features(trains, 5000)
+            self.assertEqual(kept, [t for t in trains
+                                    if t.feature.type == T.ENZYME or
+                                       not _is_pruned(t, trains)])
+
+
+class ItBuildsTrainsInAPool(unittest.TestCase):
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def features(self, db, seq):
+        from giraffe.blat.frags import features
+        from giraffe.blat.frags.frags_to_features import \
+            frag_groups_to_features
+        return [(f.start, f.end, f.clockwise,
+                 f.feature_db_index.feature_index, f.is_variant, f.has_gaps,
+                 f.subset_start, f.subset_end)
+                for f in frag_groups_to_features(
+                    features._get_frag_groups(db.name, seq), db, len(seq))]
+
+    def test_ItFindsTheSameFeaturesInAPool(self):
+        """Tests that building trains on a pool of processes finds the same
+        features, in the same order"""
+        from giraffe.blat import catalog
+        settings = django.conf.settings
+        seq = open('frags/data/slow_sequence.data').read() * 30
+
+        for db_name in ('default', 'afire'):
+            db = catalog.get_database(db_name)
+            alone = self.features(db, seq)
+            (processes, min_length) = (settings.FRAGS_PROCESSES,
+                                       settings.FRAGS_POOL_MIN_LENGTH)
+            settings.FRAGS_PROCESSES = 2
+            settings.FRAGS_POOL_MIN_LENGTH = 0
+            try:
+                self.assertEqual(self.features(db, seq), alone)
+            finally:
+                settings.FRAGS_PROCESSES = processes
+                settings.FRAGS_POOL_MIN_LENGTH = min_length
+
+
+class ItStreamsFragsFromTheBinary(unittest.TestCase):
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def test_ItGroupsFragsAsTheyArrive(self):
+        """Tests that the grouped stream from bin/frags -g matches grouping
+        all the frags at once"""
+        from giraffe.blat.frags import features
+        from giraffe.blat.frags.frags_to_features import \
+            _group_frags_by_feature_index, _group_frag_stream
+
+        seqs = [
+            'GATGACGACGACAAG',
+            'A',
+            open('frags/data/slow_sequence.data').read(),
+            open('frags/data/slow_sequence.data').read() * 30,
+        ]
+        for db_name in ('default', 'afire'):
+            for seq in seqs:
+                streamed = _group_frag_stream(
+                    features._iter_frags_from_binary(db_name, seq, True))
+                grouped = _group_frags_by_feature_index(
+                    features._get_frags_from_binary(db_name, seq))
+                self.assertEqual(
+                    [(fi, map(str, frags)) for (fi, frags) in streamed],
+                    [(fi, map(str, frags)) for (fi, frags) in grouped])
+
+
+class ItScansSequencesWithNumPy(unittest.TestCase):
+
+    def setUp(self):
+        django.conf.settings.DEBUG = False
+
+    def test_ItFindsTheSameFragsAsTheBinary(self):
+        """Tests that the NumPy scanner and bin/frags agree"""
+        from giraffe.blat.frags import features, numpy_scanner
+        if not numpy_scanner.available():
+            return
+
+        seqs = [
+            'GATGACGACGACAAG',
+            'gacaag' + 't' * 4096  + 'gatgacgac',
+            'A',
+            '',
+            'TTTAAAGATGAC GACGAC\nAAGNNTTTAAA',
+            open('frags/data/slow_sequence.data').read(),
+        ]
+        for db_name in ('default', 'afire'):
+            for seq in seqs:
+                self.assertEqual(numpy_scanner.scan(db_name, seq),
+                    features._get_frags_from_binary(db_name, seq))
+
+
 if __name__ == '__main__':
     unittest.main()
 
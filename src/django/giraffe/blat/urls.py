@@ -2,6 +2,9 @@ from django.conf.urls.defaults import *
 import views
 
 urlpatterns = patterns('',
+    url(r'^/?batch/?$', views.post_batch, name='blat-post-batch'),
+    url(r'^/?batch/(\w+)/?$', views.get_batch, name='blat-get-batch'),
+    url(r'^/?job/(\w+)/(\w+)/?$', views.job, name='blat-job'),
     url(r'^/?(\w+)/(\w+)/?$', views.get, name='blat-get'),
     url(r'^/?$', views.post, name='blat-post'),
 )
@@ -1,13 +1,39 @@
 from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags
+from django.utils.http import quote_etag
+import hashlib
 import json
 import httplib
 
+import jobs
 import models
+import response_cache
+from catalog import get_database
 
 from django.shortcuts import redirect
 from django.core.urlresolvers import reverse
 
 
+def _json_response(request,res,status):
+    return _encoded_json_response(request,json.JSONEncoder().encode(res),
+                                  status)
+
+def _encoded_json_response(request,j,status):
+    if 'jsonp' in request.GET:
+        j = request.GET['jsonp']+'('+j+')'
+        return HttpResponse(j,mimetype="text/javascript",status=status)
+
+    # technically we should be returning "application/json", but
+    # in that case browsers force user to download into a file,
+    # and for debugging we want to be able to see the JSON list in
+    # browser. looks like most browsers will handle JSON sent back
+    # as text/html anyways.
+    if request.is_ajax():
+        return HttpResponse(j,mimetype="application/json",status=status)
+    return HttpResponse(j,status=status)
+
+
 """
 post view: post a sequence and run the sequence through blat and orf
 detection.
@@ -27,13 +53,22 @@ detection.
 
         3. otherwise, redirects to the 'get' view that returns JSON
         array of features.
+
+    if 'async' is specified, the sequence is queued to be annotated in
+    the background (see jobs.py) instead, and the response comes at
+    once: the 'next' redirect as above, or else 202 Accepted with a
+    JSON object of the hash and the URL of the 'job' view. until the
+    annotation is done, the 'get' view returns 202 too.
 """
 def post(request):
     assert (request.method == 'POST')
     db_name = request.POST['db']
     sequence = request.POST['sequence']
     try:
-        hash = models.Giraffe_Mappable_Model.detect_features(sequence,db_name)
+        if 'async' in request.POST:
+            hash = jobs.queue(sequence,db_name)
+        else:
+            hash = models.Giraffe_Mappable_Model.detect_features(sequence,db_name)
         if 'next' in request.POST:
             u = request.POST['next']
             if u.endswith('/'):
@@ -41,6 +76,12 @@ def post(request):
             else:
                 u = u+'/'+hash+'/'+db_name
             return redirect(u)
+        if 'async' in request.POST:
+            url = reverse(job,args=[hash,db_name])
+            res = _json_response(request,{ "hash" : hash, "job" : url },
+                                 httplib.ACCEPTED)
+            res['Location'] = url
+            return res
         return redirect(reverse(get,args=[hash,db_name]))
     except Exception as e:
         # print 'Blat error on sequence: '+str(sequence)
@@ -54,36 +95,56 @@ def post(request):
             return redirect(u)
         raise e
 
-def get(request,hash,db_name):
+def _batch_sequences(text):
     """
-    Get features of a sequence, using the sequence's sha-1 hash as the
-    identifier.
+    Returns the sequences in the 'sequences' of the 'post_batch' view;
+    raises BadSequenceError if it is not FASTA or a JSON array of
+    strings.
+    """
+    if not text.lstrip().startswith('['):
+        return models.Sequence.split_fasta(text)
+    try:
+        sequences = json.loads(text)
+    except ValueError:
+        raise models.BadSequenceError("Sequences are not valid JSON")
+    if not isinstance(sequences,list) or \
+       not all([isinstance(s,basestring) for s in sequences]):
+        raise models.BadSequenceError(
+            "Sequences are not a JSON array of strings")
+    return sequences
 
-    If the 'sc' key appears in GET dictionary, then return single
-    cutters and non-cutter features. Otherwise, return all cutters and
-    non-cutter features.
+def post_batch(request):
     """
-    db = models.Feature_Database.objects.get(name=db_name)
-    sequence = models.Sequence.objects.get(db=db,hash=hash)
+    Post many sequences at once, in 'sequences', as multi-record FASTA or
+    as a JSON array of sequences, and run them all through blat and orf
+    detection with the 'db' database.
 
-    if db.db_version != sequence.db_version:
-        print 'feature list and database out of sync!'
-        # feature out of date with database, re gather features
-        hash = models.Giraffe_Mappable_Model.detect_features(sequence.sequence,db_name)
+    Returns a JSON array of the sequences' hashes, in order, for the
+    'get' view. If 'sequences' is not a JSON array of strings, or any
+    of the sequences is not DNA, returns 400 Bad Request with the error,
+    and stores none of them.
+    """
+    assert (request.method == 'POST')
+    db_name = request.POST['db']
+    try:
+        sequences = _batch_sequences(request.POST['sequences'])
+        hashes = models.Giraffe_Mappable_Model.detect_features_many(sequences,db_name)
+    except models.BadSequenceError as e:
+        return _json_response(request,{ "error" : e.why },httplib.BAD_REQUEST)
+    return _json_response(request,hashes,httplib.OK)
 
+def _features_list(request,sequence,features,annotated):
+    """
+    Returns what the 'get' view returns for the sequence, given its
+    features and its annotated features, each in order of start.
+    """
     res = []
 
     # get automated features
 
     if 'sc' in request.GET:
-        features = []
         cutters = {}
-        for f in sequence.sequence_feature_set.order_by("start").select_related(
-            'feature_db_index',
-            'feature_db_index__feature',
-            'feature_db_index__feature__type',
-        ):
-            features.append(f)
+        for f in features:
             if f.feature.type_id == models.Feature_Type.ENZYME:
                 if f.feature.name in cutters:
                     cutters[f.feature.name] = cutters[f.feature.name]+1
@@ -91,6 +152,7 @@ def get(request,hash,db_name):
                     cutters[f.feature.name] = 1
 
         for f in features:
+            f.sequence = sequence
             if f.feature.type_id == models.Feature_Type.ENZYME:
                 if cutters[f.feature.name] == 1:
                     res.append(f.to_dict())
@@ -98,18 +160,13 @@ def get(request,hash,db_name):
                 res.append(f.to_dict())
 
     else:
-        for f in sequence.sequence_feature_set.order_by("start").select_related(
-            'feature_db_index',
-            'feature_db_index__feature',
-            'feature_db_index__feature__type',
-        ):
+        for f in features:
+            f.sequence = sequence
             res.append(f.to_dict())
 
     # get annotated features
 
-    for f in sequence.sequence_feature_annotated_set.order_by(
-        "start"
-    ).select_related('feature_type'):
+    for f in annotated:
         res.append(f.to_dict())
 
     # now sort everything by start
@@ -121,29 +178,170 @@ def get(request,hash,db_name):
     if 'sequence' in request.GET:
         # also asked for sequence
         res.append(sequence.sequence)
+    return res
 
-    j = json.JSONEncoder().encode(res)
+def get(request,hash,db_name):
+    """
+    Get features of a sequence, using the sequence's sha-1 hash as the
+    identifier.
 
-    if 'jsonp' in request.GET:
-        j = request.GET['jsonp']+'('+j+')'
-        http_res = HttpResponse(j,mimetype="text/javascript",status=httplib.OK)
+    If the 'sc' key appears in GET dictionary, then return single
+    cutters and non-cutter features. Otherwise, return all cutters and
+    non-cutter features.
+    """
+    db = get_database(db_name)
+    sequence = models.Sequence.objects.get(db=db,hash=hash)
 
+    # queued with 'async', and not annotated yet
+    status = _job_status(sequence)
+    if status['status'] != 'done':
+        return _job_response(request,hash,db_name,status)
+
+    if db.db_version != sequence.db_version:
+        print 'feature list and database out of sync!'
+        # feature out of date with database, re gather features
+        hash = models.Giraffe_Mappable_Model.detect_features(sequence.sequence,db_name)
+        sequence = models.Sequence.objects.get(id=sequence.id)
+
+    # the ETag is made of the cache key, which changes when the sequence
+    # is re-blatted, see response_cache.py. it is weak, as the body may
+    # be sent gzipped or not
+    sc = 'sc' in request.GET
+    with_sequence = 'sequence' in request.GET
+    etag = None
+    if response_cache.settled(sequence):
+        etag = response_cache.key(sequence,sc,with_sequence)
+        if 'jsonp' in request.GET:
+            etag = hashlib.sha1(
+                etag+request.GET['jsonp'].encode('utf-8')).hexdigest()
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH','')
+
+    if if_none_match.strip() == '*' or \
+       (etag and etag in parse_etags(if_none_match)):
+        http_res = HttpResponseNotModified()
     else:
-        # technically we should be returning "application/json", but
-        # in that case browsers force user to download into a file,
-        # and for debugging we want to be able to see the JSON list in
-        # browser. looks like most browsers will handle JSON sent back
-        # as text/html anyways.
-        if request.is_ajax():
-            http_res = HttpResponse(j,mimetype="application/json",status=httplib.OK)
-        else:
-            http_res = HttpResponse(j,status=httplib.OK)
+        # the JSON is cached until the sequence is re-blatted too
+        def build():
+            return json.JSONEncoder().encode(_features_list(request,sequence,
+                sequence.sequence_feature_set.order_by("start").select_related(
+                    'feature_db_index',
+                    'feature_db_index__feature',
+                    'feature_db_index__feature__type',
+                ),
+                sequence.sequence_feature_annotated_set.order_by(
+                    "start"
+                ).select_related('feature_type')))
+        j = response_cache.get_json(sequence,sc,with_sequence,build)
+        http_res = _encoded_json_response(request,j,httplib.OK)
+    if etag:
+        http_res['ETag'] = 'W/'+quote_etag(etag)
 
     # we tell browser to cache this; if the sequence change, the hash would
     # change. the only danger is if we re-blat the sequence, in that case the
     # features list cached by browser will be out of date. so client
-    # should attach some kind of CGI string to invalidate cache.
+    # should attach some kind of CGI string to invalidate cache, or
+    # revalidate with the ETag.
     http_res['Cache-Control'] = 'max-age=2592000'
     return http_res
 
 
+# Hashes looked up with each set of queries by the 'get_batch' view
+BATCH_GET_SIZE = 500
+
+def get_batch(request,db_name):
+    """
+    Get features of many sequences at once, by their hashes: a comma
+    separated 'hashes' list, or 'hash' keys. 'sc' and 'sequence' work as
+    in the 'get' view.
+
+    Returns a JSON object with, for each hash, what the 'get' view
+    returns for it: its features, or the status of its annotation job
+    while that is not done, or null if there is no such sequence. Takes
+    the same few queries for up to BATCH_GET_SIZE hashes.
+    """
+    db = get_database(db_name)
+    hashes = []
+    seen = set()
+    for h in request.GET.getlist('hash')+request.GET.get('hashes','').split(','):
+        h = h.strip()
+        if h and h not in seen:
+            hashes.append(h)
+            seen.add(h)
+
+    res = dict([(h,None) for h in hashes])
+    done = True
+    for b in range(0,len(hashes),BATCH_GET_SIZE):
+        sequences = dict([(s.id,s) for s in models.Sequence.objects.filter(
+            db=db,hash__in=hashes[b:b+BATCH_GET_SIZE])])
+
+        # queued with 'async', and not annotated yet
+        for j in models.Annotation_Job.objects.filter(
+            sequence__in=sequences.keys()
+        ).exclude(status=models.Annotation_Job.DONE):
+            res[sequences.pop(j.sequence_id).hash] = j.to_dict()
+            done = False
+
+        for s in sequences.values():
+            if db.db_version != s.db_version:
+                print 'feature list and database out of sync!'
+                # feature out of date with database, re gather features
+                models.Giraffe_Mappable_Model.detect_features(s.sequence,db_name)
+
+        features = dict([(i,[]) for i in sequences])
+        for f in models.Sequence_Feature.objects.filter(
+            sequence__in=sequences.keys()
+        ).order_by("start").select_related(
+            'feature_db_index',
+            'feature_db_index__feature',
+            'feature_db_index__feature__type',
+        ):
+            features[f.sequence_id].append(f)
+
+        annotated = dict([(i,[]) for i in sequences])
+        for f in models.Sequence_Feature_Annotated.objects.filter(
+            sequence__in=sequences.keys()
+        ).order_by("start").select_related('feature_type'):
+            annotated[f.sequence_id].append(f)
+
+        for (i,s) in sequences.items():
+            res[s.hash] = _features_list(request,s,features[i],annotated[i])
+
+    http_res = _json_response(request,res,httplib.OK)
+    if done and None not in res.values():
+        # as for the 'get' view; a hash not found now may be posted later
+        http_res['Cache-Control'] = 'max-age=2592000'
+    else:
+        http_res['Cache-Control'] = 'no-cache'
+    return http_res
+
+
+def _job_status(sequence):
+    """
+    Returns the dict of the sequence's annotation job; sequences
+    annotated when they were posted have none, and are done.
+    """
+    for j in models.Annotation_Job.objects.filter(sequence=sequence):
+        return j.to_dict()
+    return { "status" : "done" }
+
+def _job_response(request,hash,db_name,status):
+    if status['status'] == 'done':
+        status['url'] = reverse(get,args=[hash,db_name])
+        code = httplib.OK
+    elif status['status'] == 'failed':
+        code = httplib.INTERNAL_SERVER_ERROR
+    else:
+        code = httplib.ACCEPTED
+    http_res = _json_response(request,status,code)
+    http_res['Cache-Control'] = 'no-cache'
+    return http_res
+
+def job(request,hash,db_name):
+    """
+    Get the status of a sequence's annotation job, as a JSON object:
+    'pending', 'running' (202 Accepted), 'failed' with the error (500),
+    or 'done' with the URL of the 'get' view (200).
+    """
+    db = get_database(db_name)
+    sequence = models.Sequence.objects.get(db=db,hash=hash)
+    return _job_response(request,hash,db_name,_job_status(sequence))
@@ -107,3 +107,62 @@ STATIC_ANALYZE_ROOT = 'analyze/static'
 
 SESSION_COOKIE_NAME = 'giraffe'
 
+# How blat/frags scans sequences for feature fragments: 'library' runs the
+# scanner in-process (needs blat/frags/bin/libfrags.so, falls back to the
+# binary if it has not been built), 'binary' runs blat/frags/bin/frags,
+# 'server' talks to a running "bin/frags -s FRAGS_SERVER_SOCKET ..." server
+# (send it SIGHUP to reload rebuilt databases),
+# 'numpy' scans with NumPy and needs no C compiler (falls back to the binary
+# if NumPy is not installed).
+FRAGS_ENGINE = 'library'
+FRAGS_SERVER_SOCKET = '/tmp/giraffe-frags.sock'
+
+# Threads the 'library' engine may use to scan one long sequence, per
+# feature database (default 1). For the server, append ":<threads>" to the
+# database's file name on its command line instead.
+FRAGS_SCAN_THREADS = {
+    'default' : 1,
+    'afire' : 1,
+}
+
+# How often, in seconds, a process re-reads a feature database's version
+# to notice that it has been rebuilt (see blat/catalog.py).
+FEATURE_CATALOG_TTL = 60
+
+# How many trains of fragments of one feature index may be extended at
+# once when annotating; on repetitive sequences the worst scoring ones
+# are left as they are beyond that. None for no limit.
+FRAGS_BEAM_WIDTH = 64
+
+# Whether to drop, while building trains, the copies of a train that are
+# made of the same fragments and can only do worse. Faster on repetitive
+# sequences, but may change the features found.
+FRAGS_DROP_DOMINATED = False
+
+# Processes to build the trains of long sequences on, for sequences of at
+# least FRAGS_POOL_MIN_LENGTH bases. 1 builds them in the annotating process.
+FRAGS_PROCESSES = 1
+FRAGS_POOL_MIN_LENGTH = 100000
+
+# The stages that annotate a sequence, as (keyword argument of
+# Sequence.replace_annotations, dotted path of the function) pairs (see
+# blat/annotate.py), and the threads the stages after the first run on at
+# the same time as it. 0 runs them one after the other.
+ANNOTATION_STAGES = (
+    ('features', 'giraffe.blat.frags.features.find_features'),
+    ('orfs', 'giraffe.blat.annotate.find_orfs'),
+)
+ANNOTATION_THREADS = 2
+
+# Threads in each web process that annotate the sequences posted with
+# 'async' (see blat/jobs.py). With 0, run "manage.py annotation_worker"
+# instead. A job still running ANNOTATION_JOB_LEASE seconds after it
+# started, as when its process stopped, is run again.
+ANNOTATION_JOB_WORKERS = 1
+ANNOTATION_JOB_LEASE = 1800
+
+# Where to cache the JSON of the features of sequences, as a Django cache
+# backend URI (see blat/response_cache.py); '' to cache nothing. Use a
+# backend shared by the processes, such as memcached, when there are
+# several.
+BLAT_CACHE_BACKEND = 'locmem://?max_entries=1000'